@@ -7,62 +7,36 @@
 
 import streamlit as st
 import pandas as pd
-import unicodedata
-import altair as alt
-from io import BytesIO
-from datetime import datetime, date
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+import os
+import uuid
+from datetime import datetime
+from functools import partial
+
+import crm_report
+
+from crm_report import (
+    canal_ordem, canal_padrao, canal_prospeccao, mkt_canais, phase_order, phase_colors, TAXONOMY_PATH,
+    EXCEL_MIME, REPORT_CACHE_MAX_BYTES, DATASET_MAX_BYTES,
+    load_crm_datasets, file_sha256, combined_hash, file_labels, dados_cols, invalid_dates, unknown_phases,
+    default_period, report_base, report_part, REPORT_PARTS, chart_freq, daily_series, reunioes,
+    COHORT_FREQS, COHORT_MARCOS, CHART_MAX_POINTS, cohort_table,
+    build_excel, build_pdf, LRUCache, DatasetStore, ReportJobs, Trace, stage, rss_bytes,
+)
 
 # ======== CONFIG ========
 st.set_page_config(page_title="Relatório CRM — v12", layout="wide")
 st.title("Gerador de Relatório CRM — v12")
-st.caption("Envie o CSV do CRM (separador ';' ou ','). O app detecta separador e encoding automaticamente.")
-
-# ========================= Helpers =========================
-def strip_accents(s: str) -> str:
-    return "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
-
-def norm_phase(s):
-    if pd.isna(s):
-        return ""
-    s = str(s).strip().lower()
-    s = strip_accents(s)
-    s = (s.replace("r$", "")
-           .replace("  ", " ").replace("–", "-").replace("—", "-")
-           .replace(" -", "").replace("-", " "))
-    return " ".join(s.split())
-
-def norm_text(x):
-    return strip_accents(str(x).strip().lower()) if pd.notna(x) else ""
-
-def pct(a, b):
-    return round((a / b * 100) if b else 0, 2)
-
-def count_set(series_norm, allowed_set):
-    return series_norm.isin(allowed_set).sum()
-
-def full_dates(start, end):
-    rng = pd.date_range(pd.to_datetime(start), pd.to_datetime(end), freq="D")
-    return pd.DataFrame({"Dia": pd.to_datetime(rng)})
-
-def read_crm_csv(uploaded_file) -> pd.DataFrame:
-    raw = uploaded_file.getvalue()
-    enc_used = "utf-8"
-    for enc in ("utf-8", "latin1"):
-        try:
-            _ = raw.decode(enc, errors="strict")
-            enc_used = enc
-            break
-        except Exception:
-            continue
-    text = raw.decode(enc_used, errors="ignore")
-    sample = "\n".join(text.splitlines()[:20])
-    delim = ";" if sample.count(";") >= sample.count(",") else ","
-    return pd.read_csv(
-        BytesIO(raw), sep=delim, engine="python", encoding=enc_used,
-        on_bad_lines="skip", dtype_backend="numpy_nullable",
-    )
+st.caption("Envie um ou mais CSVs do CRM (separador ';' ou ','). O app detecta separador e encoding automaticamente "
+           "e junta os arquivos; um negócio repetido entre arquivos fica com as linhas do último enviado.")
+
+# ======== Instrumentação ========
+# Cada rerun mede suas etapas (tempo, linhas, delta de memória). ?debug=1 na URL mostra o
+# painel na barra lateral; com CRM_METRICS_LOG (arquivo ou "-" = stderr) cada rerun vira uma linha JSON.
+METRICS_LOG = os.environ.get("CRM_METRICS_LOG")
+DEBUG = st.query_params.get("debug") == "1"
+if "sessao_id" not in st.session_state:
+    st.session_state["sessao_id"] = uuid.uuid4().hex[:12]
+trace = Trace(sessao=st.session_state["sessao_id"]).start()
 
 # ======= Filtro com Checkboxes — melhor UX =======
 def checkbox_grid(label, options, key, default_all=True, columns=2):
@@ -88,76 +62,90 @@ def checkbox_grid(label, options, key, default_all=True, columns=2):
                 st.session_state[key].discard(opt)
     return list(st.session_state[key])
 
+# ========================= Cache (ingestão e tabelas) =========================
+# Cada clique em filtro reexecuta o script inteiro: a base limpa (df + cubo) fica num
+# repositório único do processo, chaveado pelo hash do conteúdo e compartilhado entre
+# sessões — N pessoas olhando o mesmo export custam uma cópia e uma carga. Cada sessão
+# segura a base que está vendo; bases sem sessões saem após DATASET_TTL_S ociosas.
+# Com CRM_SNAPSHOT_DIR definido, a base limpa também vai para disco (Feather) e
+# uploads repetidos do mesmo arquivo, mesmo após reinício, pulam o parse. Um export
+# novo é comparado ao último ingerido: só as linhas novas/alteradas são processadas.
+SNAPSHOT_DIR = os.environ.get("CRM_SNAPSHOT_DIR")
+DATASET_TTL_S = int(os.environ.get("CRM_DATASET_TTL_S", 15 * 60))
+DATASET_MAX_MB = int(os.environ.get("CRM_DATASET_MAX_MB", DATASET_MAX_BYTES // 2**20))
+
+@st.cache_resource
+def dataset_store():
+    return DatasetStore(ttl=DATASET_TTL_S, max_bytes=DATASET_MAX_MB * 2**20)
+
+# Tabelas por estado de filtros: uma instância por processo (o script reexecuta a cada clique; cache_resource mantém o objeto)
+@st.cache_resource
+def report_cache():
+    return LRUCache(max_bytes=REPORT_CACHE_MAX_BYTES, shared=lambda: dataset_store().datasets())
+
+# Pool das partes pesadas e das exportações (resultados no mesmo cache de tabelas)
+@st.cache_resource
+def report_jobs():
+    return ReportJobs(report_cache())
+
 # ========================= Upload =========================
-up = st.file_uploader("CSV do CRM", type=["csv"])
-if up is None:
-    st.info("⬆️ Envie um CSV para começar.")
+ups = st.file_uploader("CSV do CRM", type=["csv"], accept_multiple_files=True)
+if not ups:
+    dataset_store().release(st.session_state["sessao_id"])
+    report_jobs().release(st.session_state["sessao_id"])
+    st.info("⬆️ Envie um ou mais CSVs para começar.")
     st.stop()
 
+# altair só depois do upload: a tela inicial não espera por ele (já carregado se houve aquecimento)
+with stage("import_altair"):
+    import altair as alt
+
+with stage("hash_arquivo"):
+    file_hashes = [file_sha256(up) for up in ups]
+    file_hash = file_hashes[0] if len(ups) == 1 else combined_hash(file_hashes)
+arquivos = file_labels([up.name for up in ups])
 try:
-    df_raw = read_crm_csv(up)
+    # cada upload é o próprio arquivo em memória, lido em blocos sem cópias do conteúdo;
+    # vários arquivos são lidos em paralelo e juntados numa base só
+    with stage("ingestao"), st.spinner("Processando CSV..."):
+        ds = dataset_store().acquire(file_hash, st.session_state["sessao_id"],
+                                     lambda: load_crm_datasets(ups, arquivos, file_hashes, SNAPSHOT_DIR))
+except KeyError as e:
+    st.error(e.args[0])
+    st.stop()
 except Exception as e:
     st.error(f"Não consegui ler o CSV. Detalhe: {e}")
     st.stop()
-
-expected = {
-    "Fase": ["Fase"],
-    "Responsável": ["Responsável", "Responsavel"],
-    "Nome do Negócio": ["Nome do Negócio", "Nome do negocio", "Nome do negócio"],
-    "Fonte": ["Fonte"],
-    "Criado": ["Criado", "Data de criação", "Data de criacao"],
-    "Motivo de perda": ["Motivo de perda.1", "Motivo de perda_1", "Motivo de perda 1"],
-}
-colmap = {}
-for wanted, cands in expected.items():
-    for c in cands:
-        if c in df_raw.columns:
-            colmap[wanted] = c
-            break
-missing = [k for k in expected if k not in colmap]
-if missing:
-    st.error(f"Faltam colunas no CSV: {missing}\nColunas recebidas: {list(df_raw.columns)}")
-    st.stop()
-
-df = df_raw[[colmap[k] for k in expected]].copy()
-df.columns = list(expected.keys())
-df["Criado"] = pd.to_datetime(df["Criado"], errors="coerce", dayfirst=True)
-df["_fase_norm"] = df["Fase"].apply(norm_phase)
-
-# ===== Mapeamento de Fonte -> Canal (inclui Base CLT/SEC) =====
-map_dict = {
-    "site": "Google Ads",
-    "face - metaads": "Trafego Pago - Face",
-    "facebook- meta ads": "Trafego Pago - Face",
-    "facebook - meta ads": "Trafego Pago - Face",
-    "facebook- metaads": "Trafego Pago - Face",
-    "facebook meta ads": "Trafego Pago - Face",
-    "insta - metaads": "Trafego Pago - Insta",
-    "instagram - meta ads": "Trafego Pago - Insta",
-    "instagram- meta ads": "Trafego Pago - Insta",
-    "instagram meta ads": "Trafego Pago - Insta",
-    "lp": "Impulsionamento Instagram",
-    "prospeccao ativa": "Prospecção Ativa",
-    "prospecção ativa": "Prospecção Ativa",
-    "whatsapp": "Inbound",
-    "indicacao": "Indicação",
-    "indicação": "Indicação",
-    "base clt/sec": "Base CLT/SEC",
-    "base clt sec": "Base CLT/SEC",
-}
-df["Canal de Origem"] = df["Fonte"].apply(lambda x: map_dict.get(norm_text(x), "Outros"))
-
-canal_ordem = [
-    "Google Ads","Trafego Pago - Face","Trafego Pago - Insta",
-    "Impulsionamento Instagram","Prospecção Ativa","Inbound",
-    "Indicação","Base CLT/SEC","Outros"
-]
+df, base_cube, delta = ds["df"], ds["cubo"], ds["delta"]
+trace.meta.update(arquivo=file_hash[:12], arquivos=len(ups), linhas=len(df))
+if df.attrs.get("duplicadas_removidas"):
+    st.caption(f"ℹ️ {df.attrs['duplicadas_removidas']} linha(s) de negócios repetidos entre arquivos "
+               "descartada(s) (vale a versão do último arquivo).")
+if df.attrs.get("aviso_incremental"):
+    st.caption(f"⚠️ {df.attrs['aviso_incremental']}")
+if df.attrs.get("linhas_ignoradas"):
+    st.caption(f"⚠️ {df.attrs['linhas_ignoradas']} linha(s) malformada(s) ignorada(s) na leitura do CSV.")
+if invalid_dates(df):
+    st.caption(f"⚠️ {invalid_dates(df)} linha(s) com data de criação em formato não reconhecido: ficam sem data "
+               "(fora do filtro de período e da série diária).")
+desconhecidas = unknown_phases(df)
+if len(desconhecidas):
+    with st.expander(f"⚠️ {len(desconhecidas)} fase(s) fora da taxonomia contadas como \"Em Atendimento\""):
+        st.dataframe(desconhecidas.reset_index(), hide_index=True, use_container_width=True)
+        st.caption(f"Para classificá-las, inclua-as em {TAXONOMY_PATH.name} e reinicie o app.")
+
+if delta is not None:
+    with st.expander(f"🔄 Mudanças desde o export anterior ({len(delta['transicoes'])} negócio(s) mudaram de fase)"):
+        d1, d2, d3 = st.columns(3)
+        with d1: st.metric("Negócios novos", delta["negocios_novos"])
+        with d2: st.metric("Negócios removidos", delta["negocios_removidos"])
+        with d3: st.metric("Linhas reprocessadas", delta["linhas_processadas"])
+        st.dataframe(delta["transicoes"], use_container_width=True)
 
 # ========================= Filtros =========================
 st.sidebar.header("Filtros")
 
-min_d = pd.to_datetime(df["Criado"].min()).date() if df["Criado"].notna().any() else date.today()
-max_d = pd.to_datetime(df["Criado"].max()).date() if df["Criado"].notna().any() else date.today()
+min_d, max_d = default_period(df)
 d_ini, d_fim = st.sidebar.date_input("Período (Criado)", value=(min_d, max_d))
 if isinstance(d_ini, tuple):
     d_ini, d_fim = d_ini
@@ -170,471 +158,312 @@ canais = [c for c in canal_ordem if c in df["Canal de Origem"].unique()] + sorte
 )
 c1, c2, c3 = st.sidebar.columns(3)
 if c1.button("Somente Mkt"):
-    st.session_state["canal_grid"] = set([c for c in canais if c in ["Google Ads","Trafego Pago - Face","Trafego Pago - Insta","Impulsionamento Instagram","Inbound"]])
+    st.session_state["canal_grid"] = set([c for c in canais if c in mkt_canais])
 if c2.button("Somente Prospecção"):
-    st.session_state["canal_grid"] = set(["Prospecção Ativa"])
-if c3.button("Exceto Outros"):
-    st.session_state["canal_grid"] = set([c for c in canais if c != "Outros"])
+    st.session_state["canal_grid"] = set([canal_prospeccao])
+if c3.button(f"Exceto {canal_padrao}"):
+    st.session_state["canal_grid"] = set([c for c in canais if c != canal_padrao])
 
 sel_canais = checkbox_grid("Canais de Origem", canais, key="canal_grid", default_all=True, columns=1)
 
-only_prospec = st.sidebar.checkbox("Focar apenas em Prospecção Ativa (gráficos por vendedora)", value=False)
-
-mask = pd.Series(True, index=df.index)
-if df["Criado"].notna().any():
-    mask &= df["Criado"].dt.date.between(d_ini, d_fim)
-if sel_vendedoras:
-    mask &= df["Responsável"].isin(sel_vendedoras)
-if sel_canais:
-    mask &= df["Canal de Origem"].isin(sel_canais)
-df = df[mask].copy()
-base_vendedora_df = df if not only_prospec else df[df["Canal de Origem"] == "Prospecção Ativa"]
-
-# ===== Labels / conjuntos de fases =====
-label_perdidos = {
-    "Sem retorno": {"sem retorno"},
-    "Sem Interesse": {"sem interesse"},
-    "Fora do Perfil": {"fora do perfil"},
-    "Outros/Perdido": {"outros / perdido","outros/perdido","outros perdido"},
-    "Abaixo de R$500K": {"abaixo de 500k","abaixo de r$500k","abaixo de 500 k","abaixo de 500 mil"},
-}
-labels_reuniao_agendando = {"agendando reuniao","agendamento de reuniao"}
-labels_reuniao_agendada = {"reuniao agendada","reunioes agendadas"}
-labels_reuniao_all = labels_reuniao_agendando | labels_reuniao_agendada
-
-# >>> Atualizações aqui
-labels_proposta = {"proposta e negociacao","follow up proposta"}
-labels_finalizando = {
-    "aprovacao da proposta",
-    "proposta aceita | gerar contrato",
-    "compliance",
-    "compliance | aguardando scd",
-    "compliance | cliente em ajuste",
-    "compliance aprovado",
-    "clicksign | assinatura",
-    "assinatura pendente",
-    "enviar boleto",
-    "aguardando pagamento",
-    "pagamento recebido",
-}
-labels_venda = {"negocio fechado","negocios fechados"}
-
-# ========================= Tabelas por canal =========================
-funil_rows = []
-for canal in canal_ordem:
-    g = df[df["Canal de Origem"] == canal]
-    total = len(g)
-    row = {"Canal de Origem": canal, "Leads Recebidos": total}
-    for colname, variants in label_perdidos.items():
-        row[colname] = count_set(g["_fase_norm"], variants)
-    row["Agendando Reunião"]      = count_set(g["_fase_norm"], labels_reuniao_agendando)
-    row["Reuniões Agendadas"]     = count_set(g["_fase_norm"], labels_reuniao_agendada)
-    row["Proposta e Negociação"]  = count_set(g["_fase_norm"], labels_proposta)
-    row["Finalizando Venda"]      = count_set(g["_fase_norm"], labels_finalizando)   # NOVA
-    row["Negócio Fechado"]        = count_set(g["_fase_norm"], labels_venda)
-    anteriores = sum(v for k, v in row.items() if k not in {"Canal de Origem","Leads Recebidos"})
-    row["Em Atendimento"]         = max(total - anteriores, 0)
-    funil_rows.append(row)
-
-funil_df = pd.DataFrame(funil_rows)
-expected_cols = [
-    "Canal de Origem","Leads Recebidos",
-    "Sem retorno","Sem Interesse","Fora do Perfil","Outros/Perdido","Abaixo de R$500K",
-    "Agendando Reunião","Reuniões Agendadas","Proposta e Negociação","Finalizando Venda","Negócio Fechado","Em Atendimento"
-]
-for c in expected_cols:
-    if c not in funil_df.columns: funil_df[c] = 0
-funil_df = funil_df[expected_cols]
-total_row = {"Canal de Origem":"TOTAL"}
-for c in expected_cols[1:]:
-    total_row[c] = funil_df[c].sum()
-funil_df = pd.concat([funil_df, pd.DataFrame([total_row])], ignore_index=True)
-
-conv_rows = []
-for canal in canal_ordem:
-    g = df[df["Canal de Origem"] == canal]
-    leads = len(g); reun = count_set(g["_fase_norm"], labels_reuniao_all); vend = count_set(g["_fase_norm"], labels_venda)
-    conv_rows.append({"Canal de Origem": canal,
-                      "% Reuniões/Leads": pct(reun, leads),
-                      "% Vendas/Leads": pct(vend, leads),
-                      "% Vendas/Reuniões": pct(vend, reun)})
-leads_tot = len(df); reun_tot = count_set(df["_fase_norm"], labels_reuniao_all); vend_tot = count_set(df["_fase_norm"], labels_venda)
-conv_rows.append({"Canal de Origem":"TOTAL",
-                  "% Reuniões/Leads": pct(reun_tot, leads_tot),
-                  "% Vendas/Leads": pct(vend_tot, leads_tot),
-                  "% Vendas/Reuniões": pct(vend_tot, reun_tot)})
-conv_df = pd.DataFrame(conv_rows)
-
-# ========================= Por vendedora (respeita filtros) =========================
-todas_vendedoras = sorted(base_vendedora_df["Responsável"].dropna().unique().tolist())
-
-prospec = base_vendedora_df
-prospec_rows = []
-for resp in todas_vendedoras:
-    g = prospec[prospec["Responsável"] == resp]
-    leads = len(g); reun = count_set(g["_fase_norm"], labels_reuniao_all); vend = count_set(g["_fase_norm"], labels_venda)
-    prospec_rows.append({"Vendedora": resp, "Leads Gerados": leads, "Reuniões Agendadas": reun, "Vendas": vend,
-                         "Conversão Reunião (%)": pct(reun, leads), "Conversão Venda (%)": pct(vend, leads)})
-prospec_rows.append({"Vendedora":"TOTAL","Leads Gerados":len(prospec),
-                     "Reuniões Agendadas":count_set(prospec["_fase_norm"], labels_reuniao_all),
-                     "Vendas":count_set(prospec["_fase_norm"], labels_venda),
-                     "Conversão Reunião (%)": pct(count_set(prospec["_fase_norm"], labels_reuniao_all), len(prospec)) if len(prospec) else 0,
-                     "Conversão Venda (%)": pct(count_set(prospec["_fase_norm"], labels_venda), len(prospec)) if len(prospec) else 0})
-prospec_resumo_df = pd.DataFrame(prospec_rows)
-
-prospec_funil_rows = []
-for resp in todas_vendedoras:
-    g = base_vendedora_df[base_vendedora_df["Responsável"] == resp]
-    row = {"Vendedora": resp, "Leads Gerados (base filtrada)": len(g)}
-    row["Sem retorno"] = count_set(g["_fase_norm"], {"sem retorno"})
-    row["Sem Interesse"] = count_set(g["_fase_norm"], {"sem interesse"})
-    row["Fora do Perfil"] = count_set(g["_fase_norm"], {"fora do perfil"})
-    row["Outros/Perdido"] = count_set(g["_fase_norm"], {"outros / perdido","outros/perdido","outros perdido"})
-    row["Abaixo de R$500K"] = count_set(g["_fase_norm"], {"abaixo de 500k","abaixo de r$500k","abaixo de 500 k","abaixo de 500 mil"})
-    row["Agendando Reunião"] = count_set(g["_fase_norm"], labels_reuniao_agendando)
-    row["Reuniões Agendadas"] = count_set(g["_fase_norm"], labels_reuniao_agendada)
-    row["Proposta e Negociação"] = count_set(g["_fase_norm"], labels_proposta)
-    row["Finalizando Venda"] = count_set(g["_fase_norm"], labels_finalizando)  # NOVA
-    row["Negócio Fechado"] = count_set(g["_fase_norm"], labels_venda)
-    anteriores = sum(row[k] for k in [
-        "Sem retorno","Sem Interesse","Fora do Perfil","Outros/Perdido","Abaixo de R$500K",
-        "Agendando Reunião","Reuniões Agendadas","Proposta e Negociação","Finalizando Venda","Negócio Fechado"
-    ])
-    row["Em Atendimento"] = max(row["Leads Gerados (base filtrada)"] - anteriores, 0)
-    prospec_funil_rows.append(row)
-prospec_funil_df = pd.DataFrame(prospec_funil_rows)
-if not prospec_funil_df.empty:
-    tot = {"Vendedora":"TOTAL"}
-    for c in prospec_funil_df.columns:
-        if c!="Vendedora": tot[c]=prospec_funil_df[c].sum()
-    prospec_funil_df = pd.concat([prospec_funil_df, pd.DataFrame([tot])], ignore_index=True)
-
-vend_origem_rows = []
-for resp in sorted(df["Responsável"].dropna().unique()):
-    g = df[df["Responsável"] == resp]
-    for origem, m in {
-        "Prospecção Ativa": g["Canal de Origem"].eq("Prospecção Ativa"),
-        "Leads de Mkt": g["Canal de Origem"].isin(["Google Ads","Trafego Pago - Face","Trafego Pago - Insta","Impulsionamento Instagram","Inbound"]),
-    }.items():
-        sub = g[m]; leads=len(sub); reun=count_set(sub["_fase_norm"], labels_reuniao_all); vend=count_set(sub["_fase_norm"], labels_venda)
-        vend_origem_rows.append({"Vendedora":resp,"Origem do Lead":origem,"Leads Trabalhados":leads,
-                                 "Reuniões Agendadas":reun,"Vendas":vend,
-                                 "Conversão Reunião (%)":pct(reun, leads),"Conversão Venda (%)":pct(vend, leads)})
-vend_origem_df = pd.DataFrame(vend_origem_rows)
+sel_arquivos = []
+if len(arquivos) > 1:
+    sel_arquivos = checkbox_grid("Arquivos", arquivos, key=f"arq_grid_{file_hash[:12]}", default_all=True, columns=1)
+    if set(sel_arquivos) == set(arquivos):
+        sel_arquivos = []  # todos = sem filtro (mantém o recorte do cubo base)
+
+only_prospec = st.sidebar.checkbox(f"Focar apenas em {canal_prospeccao} (gráficos por vendedora)", value=False)
+
+filtro_key = (file_hash, d_ini, d_fim, tuple(sorted(sel_vendedoras)), tuple(sorted(sel_canais)), only_prospec,
+              tuple(sorted(sel_arquivos)))
+trace.meta.update(periodo=[str(d_ini), str(d_fim)], vendedoras=len(sel_vendedoras), canais=len(sel_canais))
+
+# ========================= Relatório (cards primeiro, seções em segundo plano) =========================
+# A base filtrada e os totais por fase saem na hora (cards). Tabelas do funil, das vendedoras
+# e o cubo diário são calculados em paralelo (report_jobs) e cada seção é desenhada quando a
+# sua parte chega; mudar um filtro no meio do cálculo cancela os jobs do filtro anterior.
+with stage("relatorio (memo)"):
+    base = report_cache().get_or_compute(
+        (filtro_key, "base"),
+        lambda: report_base(df, d_ini, d_fim, sel_vendedoras, sel_canais, only_prospec, sel_arquivos))
+    partes = {nome: partial(report_part, nome, base, base_cube) for nome in REPORT_PARTS}
+    report_jobs().submit(st.session_state["sessao_id"], filtro_key, partes)  # já começam enquanto os cards saem
+rel = dict(base)  # o que está em cache não é alterado: as partes entram numa cópia rasa
+df = rel["df"]
+fases_tot = rel["fases_tot"]
 
 # ========================= Visão geral (cards) =========================
 st.markdown("### 📊 Visão Geral (após filtros)")
 m1, m2, m3, m4, m5 = st.columns(5)
 with m1: st.metric("Leads (Total)", len(df))
-with m2: st.metric("Reuniões (Total)", int(count_set(df["_fase_norm"], labels_reuniao_all)))
-with m3: st.metric("Em Proposta", int(count_set(df["_fase_norm"], labels_proposta)))
-with m4: st.metric("Finalizando Venda", int(count_set(df["_fase_norm"], labels_finalizando)))
-with m5: st.metric("Vendas (Total)", int(count_set(df["_fase_norm"], labels_venda)))
-
-# Paleta e ordem fixa das fases (inclui Finalizando)
-phase_order = [
-    "Em Atendimento",
-    "Agendando Reunião",
-    "Reuniões Agendadas",
-    "Proposta e Negociação",
-    "Finalizando Venda",        # NOVA
-    "Negócio Fechado",
-    "Abaixo de R$500K",
-    "Fora do Perfil",
-    "Sem Interesse",
-    "Sem retorno",
-    "Outros/Perdido",
-]
-# amarelo -> verdes -> vermelhos (adicionamos 1 verde para "Finalizando Venda")
-phase_colors = [
-    "#fbbf24",  # Em Atendimento (amarelo)
-    "#86efac",  # Agendando
-    "#4ade80",  # Reuniões agendadas
-    "#22c55e",  # Proposta
-    "#16a34a",  # Finalizando (verde mais escuro)
-    "#0ea5a8",  # Negócio Fechado (verde/teal)
-    "#fca5a5",  # Abaixo de 500k
-    "#f87171",  # Fora do Perfil
-    "#dc2626",  # Sem Interesse
-    "#991b1b",  # Sem retorno
-    "#ef4444",  # Outros/Perdido
-]
-phase_rank = {n:i for i,n in enumerate(phase_order)}
-
-# Leads por canal
-st.markdown("### 📈 Canais — Leads por Canal")
-base = funil_df[funil_df["Canal de Origem"]!="TOTAL"][["Canal de Origem","Leads Recebidos"]]
-st.altair_chart(
-    alt.Chart(base).mark_bar().encode(
-        x="Leads Recebidos:Q", y=alt.Y("Canal de Origem:N", sort="-x")),
-    use_container_width=True
-)
+with m2: st.metric("Reuniões (Total)", int(reunioes(fases_tot)))
+with m3: st.metric("Em Proposta", int(fases_tot["Proposta e Negociação"]))
+with m4: st.metric("Finalizando Venda", int(fases_tot["Finalizando Venda"]))
+with m5: st.metric("Vendas (Total)", int(fases_tot["Negócio Fechado"]))
+
+def render_funil(p):
+    # Leads por canal
+    funil_df = p["funil_df"]
+    st.markdown("### 📈 Canais — Leads por Canal")
+    base = funil_df[funil_df["Canal de Origem"]!="TOTAL"][["Canal de Origem","Leads Recebidos"]]
+    with stage("grafico_leads_canal", len(base)):
+        st.altair_chart(
+            alt.Chart(base).mark_bar().encode(
+                x="Leads Recebidos:Q", y=alt.Y("Canal de Origem:N", sort="-x")),
+            use_container_width=True
+        )
 
-# Fases x Canal (normalizado, tooltip=Qtd) — inclui Finalizando
-fases_cols = [
-    "Sem retorno","Sem Interesse","Fora do Perfil","Outros/Perdido","Abaixo de R$500K",
-    "Agendando Reunião","Reuniões Agendadas","Proposta e Negociação","Finalizando Venda","Negócio Fechado","Em Atendimento"
-]
-melt = funil_df[funil_df["Canal de Origem"]!="TOTAL"].melt(
-    id_vars=["Canal de Origem"], value_vars=fases_cols, var_name="Fase", value_name="Qtd")
-melt["fase_ord"] = melt["Fase"].map(phase_rank).astype("int64")
-st.markdown("### 📊 Distribuição de Fases por Canal (proporção)")
-st.altair_chart(
-    alt.Chart(melt).mark_bar().encode(
-        x=alt.X("sum(Qtd):Q", stack="normalize", title="Proporção"),
-        y=alt.Y("Canal de Origem:N", sort="-x"),
-        color=alt.Color("Fase:N", sort=phase_order, scale=alt.Scale(domain=phase_order, range=phase_colors)),
-        tooltip=[alt.Tooltip("Canal de Origem:N"), alt.Tooltip("Fase:N"), alt.Tooltip("sum(Qtd):Q", title="Quantidade")],
-        order=alt.Order("fase_ord:Q", sort="ascending"),
-    ).properties(height=340),
-    use_container_width=True
-)
+    # Fases x Canal (normalizado, tooltip=Qtd) — inclui Finalizando
+    melt = p["melt"]
+    st.markdown("### 📊 Distribuição de Fases por Canal (proporção)")
+    with stage("grafico_fases_canal", len(melt)):
+        st.altair_chart(
+            alt.Chart(melt).mark_bar().encode(
+                x=alt.X("Proporção:Q", stack="zero", title="Proporção", axis=alt.Axis(format="%"),
+                        scale=alt.Scale(domain=[0, 1])),
+                y=alt.Y("Canal de Origem:N", sort="-x"),
+                color=alt.Color("Fase:N", sort=phase_order, scale=alt.Scale(domain=phase_order, range=phase_colors)),
+                tooltip=[alt.Tooltip("Canal de Origem:N"), alt.Tooltip("Fase:N"), alt.Tooltip("Qtd:Q", title="Quantidade")],
+                order=alt.Order("fase_ord:Q", sort="ascending"),
+            ).properties(height=340),
+            use_container_width=True
+        )
 
-# Conversões por canal (mantém)
-conv_melt = conv_df[conv_df["Canal de Origem"]!="TOTAL"].melt(
-    id_vars=["Canal de Origem"], var_name="Métrica", value_name="Valor")
-st.markdown("### 📈 Conversões por Canal")
-st.altair_chart(
-    alt.Chart(conv_melt).mark_bar().encode(
-        x=alt.X("Valor:Q", title="%"),
-        y=alt.Y("Canal de Origem:N", sort="-x"),
-        color="Métrica:N",
-        tooltip=[alt.Tooltip("Canal de Origem:N"),alt.Tooltip("Métrica:N"),alt.Tooltip("Valor:Q", title="%")],
-    ).properties(height=280),
-    use_container_width=True
-)
+    # Conversões por canal (mantém)
+    conv_melt = p["conv_melt"]
+    st.markdown("### 📈 Conversões por Canal")
+    with stage("grafico_conversoes", len(conv_melt)):
+        st.altair_chart(
+            alt.Chart(conv_melt).mark_bar().encode(
+                x=alt.X("Valor:Q", title="%"),
+                y=alt.Y("Canal de Origem:N", sort="-x"),
+                color="Métrica:N",
+                tooltip=[alt.Tooltip("Canal de Origem:N"),alt.Tooltip("Métrica:N"),alt.Tooltip("Valor:Q", title="%")],
+            ).properties(height=280),
+            use_container_width=True
+        )
 
-# Vendedoras (respeita filtros)
-st.markdown("### 👤 Vendedoras (respeita filtros de canal)")
-base_v = prospec_resumo_df[prospec_resumo_df["Vendedora"]!="TOTAL"][["Vendedora","Leads Gerados","Reuniões Agendadas","Vendas"]]
-st.altair_chart(
-    alt.Chart(base_v).transform_fold(
-        ["Leads Gerados","Reuniões Agendadas","Vendas"], as_=["Métrica","Valor"]
-    ).mark_bar().encode(
-        x="Valor:Q", y=alt.Y("Vendedora:N", sort="-x"), color="Métrica:N",
-        tooltip=[alt.Tooltip("Vendedora:N"), alt.Tooltip("Métrica:N"), alt.Tooltip("Valor:Q")]
-    ).properties(height=300),
-    use_container_width=True
-)
+def render_vendedoras(p):
+    # Vendedoras (respeita filtros)
+    st.markdown("### 👤 Vendedoras (respeita filtros de canal)")
+    vend_melt = p["vend_melt"]
+    with stage("grafico_vendedoras", len(vend_melt)):
+        st.altair_chart(
+            alt.Chart(vend_melt).mark_bar().encode(
+                x="Valor:Q", y=alt.Y("Vendedora:N", sort="-x"), color="Métrica:N",
+                tooltip=[alt.Tooltip("Vendedora:N"), alt.Tooltip("Métrica:N"), alt.Tooltip("Valor:Q")]
+            ).properties(height=300),
+            use_container_width=True
+        )
 
-# Funil detalhado por vendedora (quantidade) — inclui Finalizando
-st.markdown("### 📊 Funil detalhado por Vendedora")
-if not prospec_funil_df.empty:
-    pf = prospec_funil_df[prospec_funil_df["Vendedora"]!="TOTAL"].copy()
-    fases_plot = phase_order  # já na ordem desejada
-    for c in fases_plot:
-        if c not in pf.columns: pf[c]=0
-    melted_v = pf.melt(id_vars=["Vendedora"], value_vars=fases_plot, var_name="Fase", value_name="Qtd")
-    melted_v["fase_ord"] = melted_v["Fase"].map(phase_rank).astype("int64")
-    st.altair_chart(
-        alt.Chart(melted_v).mark_bar().encode(
-            x=alt.X("sum(Qtd):Q", stack="zero", title="Quantidade"),
-            y=alt.Y("Vendedora:N", sort="-x"),
-            color=alt.Color("Fase:N", sort=phase_order, scale=alt.Scale(domain=phase_order, range=phase_colors)),
-            tooltip=[alt.Tooltip("Vendedora:N"), alt.Tooltip("Fase:N"), alt.Tooltip("sum(Qtd):Q", title="Quantidade")],
-            order=alt.Order("fase_ord:Q", sort="ascending")
-        ).properties(height=320),
-        use_container_width=True
-    )
+    # Funil detalhado por vendedora (quantidade) — inclui Finalizando
+    st.markdown("### 📊 Funil detalhado por Vendedora")
+    if not p["prospec_funil_df"].empty:
+        melted_v = p["melted_v"]
+        with stage("grafico_funil_vendedora", len(melted_v)):
+            st.altair_chart(
+                alt.Chart(melted_v).mark_bar().encode(
+                    x=alt.X("Qtd:Q", stack="zero", title="Quantidade"),
+                    y=alt.Y("Vendedora:N", sort="-x"),
+                    color=alt.Color("Fase:N", sort=phase_order, scale=alt.Scale(domain=phase_order, range=phase_colors)),
+                    tooltip=[alt.Tooltip("Vendedora:N"), alt.Tooltip("Fase:N"), alt.Tooltip("Qtd:Q", title="Quantidade")],
+                    order=alt.Order("fase_ord:Q", sort="ascending")
+                ).properties(height=320),
+                use_container_width=True
+            )
+
+secoes = {"funil": st.empty(), "vendedoras": st.empty()}
+secoes["funil"].caption("⏳ Calculando o funil por canal...")
+secoes["vendedoras"].caption("⏳ Calculando as tabelas por vendedora...")
 
 # ========================= Leads criados por dia — com dias zerados (v10) =========================
+# Períodos longos viram barras semanais/mensais (chart_freq) e barras, rótulos e média
+# móvel desenham um único dataset: o payload do gráfico fica limitado.
+EIXO_FREQ = {"D": ("Dia", "%d/%m"), "W-MON": ("Semana (início)", "%d/%m"), "MS": ("Mês", "%m/%Y")}
+CHART_MAX_LABELS = 400  # acima disso os rótulos só poluem (e pesam no navegador)
+
+def serie_chart(g, by, titulo_by, eixo, show_mm):
+    titulo_x, fmt = eixo
+    tip_x = alt.Tooltip("yearmonthdate(Dia):O", title=titulo_x)
+    if by is None:
+        x = alt.X("yearmonthdate(Dia):O", title=titulo_x, axis=alt.Axis(format=fmt))
+        bars = alt.Chart().mark_bar().encode(
+            x=x, y=alt.Y("Leads:Q", title="Leads"), tooltip=[tip_x, alt.Tooltip("Leads:Q", title="Leads")])
+        off = {}
+    else:
+        cats = g[by].unique().tolist()
+        x = alt.X("yearmonthdate(Dia):O", title=titulo_x, axis=alt.Axis(format=fmt),
+                  scale=alt.Scale(paddingInner=0.2, paddingOuter=0.05))
+        off = {"xOffset": alt.XOffset(f"{by}:N", sort=cats)}
+        bars = alt.Chart().mark_bar().encode(
+            x=x, y=alt.Y("Leads:Q", title="Leads"), **off,
+            color=alt.Color(f"{by}:N", sort=cats, legend=alt.Legend(title=titulo_by)),
+            tooltip=[tip_x, alt.Tooltip(f"{by}:N", title=titulo_by), alt.Tooltip("Leads:Q")],
+        )
+    layers = [bars]
+    if len(g) <= CHART_MAX_LABELS:
+        layers.append(alt.Chart().mark_text(dy=-4, size=11).encode(
+            x=x, y="Leads:Q", text="Leads:Q", color=alt.value("#ffffff"), **off))
+    if show_mm:
+        if by is None:
+            layers.append(alt.Chart().mark_line(strokeWidth=2, color="#10b981").encode(
+                x=x, y=alt.Y("MM:Q", title="Média móvel"),
+                tooltip=[tip_x, alt.Tooltip("MM:Q", title="Média móvel")]))
+        else:
+            layers.append(alt.Chart().mark_line(strokeWidth=2).encode(
+                x=x, y=alt.Y("MM:Q", title="Média móvel"), color=alt.Color(f"{by}:N", sort=cats, legend=None)))
+    return alt.layer(*layers, data=g)
+
 st.markdown("### 📅 Leads criados por dia")
 detalhe = st.radio("Detalhar por", ["Total", "Vendedora", "Canal de Origem"], horizontal=True, key="detalhe_diario")
 show_mm = st.checkbox("Mostrar média móvel", value=True, key="mm_toggle")
 mm_window = st.slider("Janela da média móvel (dias)", 1, 14, 7, key="mm_diario", disabled=not show_mm)
 
-base_daily = df[df["Criado"].notna()].copy()
-if base_daily.empty:
-    st.info("Nenhum lead com data de criação válida no intervalo/seleção atual.")
-else:
-    base_daily["Dia"] = base_daily["Criado"].dt.floor("D")
-    all_days = full_dates(d_ini, d_fim)
-
-    if detalhe == "Total":
-        g = base_daily.groupby("Dia").size().rename("Leads").reset_index()
-        g = all_days.merge(g, on="Dia", how="left").fillna({"Leads": 0})
-        g = g.sort_values("Dia")
-        if show_mm:
-            g["MM"] = g["Leads"].rolling(mm_window, min_periods=1).mean()
-
-        bars = alt.Chart(g).mark_bar().encode(
-            x=alt.X("yearmonthdate(Dia):O", title="Dia", axis=alt.Axis(format="%d/%m")),
-            y=alt.Y("Leads:Q", title="Leads"),
-            tooltip=[alt.Tooltip("yearmonthdate(Dia):O", title="Dia"), alt.Tooltip("Leads:Q", title="Leads")],
-        )
-        labels = alt.Chart(g).mark_text(dy=-4, size=11).encode(
-            x=alt.X("yearmonthdate(Dia):O"),
-            y="Leads:Q",
-            text="Leads:Q",
-            color=alt.value("#ffffff"),
-        )
-        chart = bars + labels
-        if show_mm:
-            line = alt.Chart(g).mark_line(strokeWidth=2, color="#10b981").encode(
-                x=alt.X("yearmonthdate(Dia):O"),
-                y=alt.Y("MM:Q", title="Média móvel"),
-                tooltip=[alt.Tooltip("yearmonthdate(Dia):O", title="Dia"), alt.Tooltip("MM:Q", title="Média móvel")],
-            )
-            chart = chart + line
-
-    elif detalhe == "Vendedora":
-        cats = sorted(base_daily["Responsável"].dropna().unique().tolist())
-        if not cats:
-            st.info("Nenhuma vendedora com dados no período/seleção atual.")
-            st.stop()
-        grid = all_days.assign(key=1)
-        cats_df = pd.DataFrame({"Responsável": cats}).assign(key=1)
-        cart = grid.merge(cats_df, on="key").drop(columns="key")
-
-        g = base_daily.groupby(["Dia", "Responsável"]).size().rename("Leads").reset_index()
-        g = cart.merge(g, on=["Dia", "Responsável"], how="left").fillna({"Leads": 0})
-        g = g.sort_values(["Responsável", "Dia"])
-
-        bars = alt.Chart(g).mark_bar().encode(
-            x=alt.X("yearmonthdate(Dia):O", title="Dia", axis=alt.Axis(format="%d/%m"),
-                    scale=alt.Scale(paddingInner=0.2, paddingOuter=0.05)),
-            xOffset=alt.XOffset("Responsável:N", sort=cats),
-            y=alt.Y("Leads:Q", title="Leads"),
-            color=alt.Color("Responsável:N", sort=cats, legend=alt.Legend(title="Vendedora")),
-            tooltip=[alt.Tooltip("yearmonthdate(Dia):O", title="Dia"),
-                     alt.Tooltip("Responsável:N", title="Vendedora"),
-                     alt.Tooltip("Leads:Q")],
-        )
-        labels = alt.Chart(g).mark_text(dy=-4, size=11).encode(
-            x=alt.X("yearmonthdate(Dia):O"),
-            xOffset=alt.XOffset("Responsável:N", sort=cats),
-            y="Leads:Q",
-            text="Leads:Q",
-            color=alt.value("#ffffff"),
-        )
-        chart = bars + labels
-        if show_mm:
-            g["MM"] = g.groupby("Responsável")["Leads"].transform(
-                lambda s: s.rolling(mm_window, min_periods=1).mean()
-            )
-            lines = alt.Chart(g).mark_line(strokeWidth=2).encode(
-                x=alt.X("yearmonthdate(Dia):O"),
-                y=alt.Y("MM:Q", title="Média móvel"),
-                color=alt.Color("Responsável:N", sort=cats, legend=None),
+def render_cubo(p):
+    daily_cube = p["daily_cube"]
+    if daily_cube.empty:
+        st.info("Nenhum lead com data de criação válida no intervalo/seleção atual.")
+        return
+    all_days = pd.date_range(pd.to_datetime(d_ini), pd.to_datetime(d_fim), freq="D", name="Dia")
+    by, titulo_by, vazio = {
+        "Total": (None, None, None),
+        "Vendedora": ("Responsável", "Vendedora", "Nenhuma vendedora com dados no período/seleção atual."),
+        "Canal de Origem": ("Canal de Origem", "Canal", "Nenhum canal com dados no período/seleção atual."),
+    }[detalhe]
+    freq = chart_freq(daily_cube, all_days, by)
+    with stage("serie_diaria", len(all_days)):
+        g = daily_series(daily_cube, all_days, by, mm_window if show_mm else None, freq)
+    if by is not None and g.empty:
+        st.info(vazio)
+        return
+    if freq != "D":
+        st.caption(f"Período longo: barras por {'semana' if freq == 'W-MON' else 'mês'}"
+                   + (f" (média móvel de {mm_window} dias somada no período)." if show_mm else "."))
+
+    with stage("grafico_diario", len(g)):
+        st.altair_chart(serie_chart(g, by, titulo_by, EIXO_FREQ[freq], show_mm).properties(height=380),
+                        use_container_width=True)
+
+secoes["cubo"] = st.empty()
+secoes["cubo"].caption("⏳ Calculando a série diária...")
+
+# ========================= Coortes de criação =========================
+# Conversão de cada coorte (semana/mês de criação) até a data do export — o último Criado da
+# base —, no total, por canal ou por vendedora. Sai do cubo diário do filtro e fica no cache
+# de tabelas por (filtros, coorte, detalhe).
+st.markdown("### 🧮 Coortes de criação")
+k1, k2, k3 = st.columns(3)
+coorte_freq = k1.radio("Coorte", list(COHORT_FREQS), index=1, horizontal=True, key="coorte_freq")
+coorte_por = k2.radio("Detalhar por", ["Total", "Canal de Origem", "Vendedora"], horizontal=True, key="coorte_por")
+coorte_marco = k3.selectbox("Conversão até", list(COHORT_MARCOS), index=len(COHORT_MARCOS) - 1, key="coorte_marco")
+
+def render_coortes(p):
+    by = {"Total": None, "Canal de Origem": "Canal de Origem", "Vendedora": "Responsável"}[coorte_por]
+    freq = COHORT_FREQS[coorte_freq]
+    with stage("coortes", len(p["daily_cube"])):
+        tab = report_cache().get_or_compute((filtro_key, "coortes", freq, by, max_d),
+                                            lambda: cohort_table(p["daily_cube"], freq, by, max_d))
+    if tab.empty:
+        st.info("Nenhum lead com data de criação válida no intervalo/seleção atual.")
+        return
+    tab = tab.rename(columns={"Responsável": "Vendedora"})
+    titulo_x, fmt = EIXO_FREQ[freq]
+    x = alt.X("yearmonthdate(Coorte):O", title=f"Coorte ({titulo_x.lower()})", axis=alt.Axis(format=fmt))
+    tip = [alt.Tooltip("yearmonthdate(Coorte):T", title="Coorte"), alt.Tooltip("Idade (dias):Q"),
+           alt.Tooltip("Leads:Q")]
+    if by is None:
+        g = tab.melt(id_vars=["Coorte", "Idade (dias)", "Leads"], value_vars=[f"% {m}" for m in COHORT_MARCOS],
+                     var_name="Marco", value_name="%")
+        g["Marco"] = g["Marco"].str[2:]
+        y, n_y = alt.Y("Marco:N", sort=list(COHORT_MARCOS), title=None), len(COHORT_MARCOS)
+        tip.append(alt.Tooltip("Marco:N"))
+    else:
+        col = "Vendedora" if by == "Responsável" else by
+        g = tab[["Coorte", "Idade (dias)", col, "Leads", coorte_marco, f"% {coorte_marco}"]].rename(
+            columns={f"% {coorte_marco}": "%"})
+        y, n_y = alt.Y(f"{col}:N", title=col), g[col].nunique()
+        tip += [alt.Tooltip(f"{col}:N"), alt.Tooltip(f"{coorte_marco}:Q")]
+    if len(g) > CHART_MAX_POINTS:
+        st.caption(f"{len(g)} células: muitas para o mapa — use coortes mensais ou filtre vendedoras/canais. "
+                   "A tabela abaixo tem tudo.")
+    else:
+        with stage("grafico_coortes", len(g)):
+            st.altair_chart(
+                alt.Chart(g).mark_rect().encode(
+                    x=x, y=y, color=alt.Color("%:Q", title="%", scale=alt.Scale(scheme="greens", domain=[0, 100])),
+                    tooltip=tip + [alt.Tooltip("%:Q", title="%")],
+                ).properties(height=max(160, 22 * n_y)),
+                use_container_width=True
             )
-            chart = chart + lines
-
-    else:  # Canal de Origem
-        cats = sorted(base_daily["Canal de Origem"].dropna().unique().tolist())
-        if not cats:
-            st.info("Nenhum canal com dados no período/seleção atual.")
-            st.stop()
-        grid = all_days.assign(key=1)
-        cats_df = pd.DataFrame({"Canal de Origem": cats}).assign(key=1)
-        cart = grid.merge(cats_df, on="key").drop(columns="key")
-
-        g = base_daily.groupby(["Dia", "Canal de Origem"]).size().rename("Leads").reset_index()
-        g = cart.merge(g, on=["Dia", "Canal de Origem"], how="left").fillna({"Leads": 0})
-        g = g.sort_values(["Canal de Origem", "Dia"])
-
-        bars = alt.Chart(g).mark_bar().encode(
-            x=alt.X("yearmonthdate(Dia):O", title="Dia", axis=alt.Axis(format="%d/%m"),
-                    scale=alt.Scale(paddingInner=0.2, paddingOuter=0.05)),
-            xOffset=alt.XOffset("Canal de Origem:N", sort=cats),
-            y=alt.Y("Leads:Q", title="Leads"),
-            color=alt.Color("Canal de Origem:N", sort=cats, legend=alt.Legend(title="Canal")),
-            tooltip=[alt.Tooltip("yearmonthdate(Dia):O", title="Dia"),
-                     alt.Tooltip("Canal de Origem:N", title="Canal"),
-                     alt.Tooltip("Leads:Q")],
-        )
-        labels = alt.Chart(g).mark_text(dy=-4, size=11).encode(
-            x=alt.X("yearmonthdate(Dia):O"),
-            xOffset=alt.XOffset("Canal de Origem:N", sort=cats),
-            y="Leads:Q",
-            text="Leads:Q",
-            color=alt.value("#ffffff"),
-        )
-        chart = bars + labels
-        if show_mm:
-            g["MM"] = g.groupby("Canal de Origem")["Leads"].transform(
-                lambda s: s.rolling(mm_window, min_periods=1).mean()
-            )
-            lines = alt.Chart(g).mark_line(strokeWidth=2).encode(
-                x=alt.X("yearmonthdate(Dia):O"),
-                y=alt.Y("MM:Q", title="Média móvel"),
-                color=alt.Color("Canal de Origem:N", sort=cats, legend=None),
-            )
-            chart = chart + lines
+    with st.expander("Tabela de coortes", expanded=False):
+        st.dataframe(tab, hide_index=True, use_container_width=True)
 
-    st.altair_chart(chart.properties(height=380), use_container_width=True)
+secoes["coortes"] = st.empty()
+secoes["coortes"].caption("⏳ Calculando as coortes...")
 
 # ========================= Tabelas =========================
 st.markdown("### 📄 Tabelas")
 with st.expander("Dados Limpos", expanded=False):
-    st.dataframe(df[["Fase","Responsável","Nome do Negócio","Fonte","Criado","Motivo de perda"]])
-with st.expander("Funil Comercial do Período", expanded=False):
-    st.dataframe(funil_df)
-with st.expander("Taxas de Conversão por Canal", expanded=False):
-    st.dataframe(conv_df)
-with st.expander("Resumo por Vendedora", expanded=False):
-    st.dataframe(prospec_resumo_df)
-with st.expander("Funil Detalhado por Vendedora (base filtrada)", expanded=False):
-    st.dataframe(prospec_funil_df)
-with st.expander("Resumo por Vendedora × Origem", expanded=False):
-    st.dataframe(vend_origem_df)
-
-# ========================= Exportar Excel =========================
-buffer_xlsx = BytesIO()
-with pd.ExcelWriter(buffer_xlsx, engine="xlsxwriter") as writer:
-    df[["Fase","Responsável","Nome do Negócio","Fonte","Criado","Motivo de perda"]].to_excel(writer, "Dados_Limpos", index=False)
-    funil_df.to_excel(writer, "Funil_Comercial", index=False)
-    conv_df.to_excel(writer, "Conversao_Canal", index=False)
-    prospec_resumo_df.to_excel(writer, "Vendedora_Resumo", index=False)
-    prospec_funil_df.to_excel(writer, "Vendedora_Funil", index=False)
-    vend_origem_df.to_excel(writer, "Vendedora_Origem", index=False)
-
-st.download_button("⬇️ Baixar Excel", buffer_xlsx.getvalue(),
-                   file_name=f"Relatorio_CRM_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                   mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-# ========================= Exportar PDF =========================
-pdf_bytes = BytesIO()
-with PdfPages(pdf_bytes) as pdf:
-    fig = plt.figure(figsize=(10,6)); plt.axis("off")
-    periodo_txt = f"{d_ini.strftime('%d/%m/%Y')} a {d_fim.strftime('%d/%m/%Y')}"
-    resumo = (
-        f"Período: {periodo_txt}\n"
-        f"Leads: {len(df)} | Reuniões: {int(count_set(df['_fase_norm'], labels_reuniao_all))} | "
-        f"Em Proposta: {int(count_set(df['_fase_norm'], labels_proposta))} | "
-        f"Finalizando Venda: {int(count_set(df['_fase_norm'], labels_finalizando))} | "
-        f"Vendas: {int(count_set(df['_fase_norm'], labels_venda))}"
-    )
-    plt.text(0.05, 0.75, "Relatório CRM", fontsize=24, weight="bold")
-    plt.text(0.05, 0.6, resumo, fontsize=14)
-    pdf.savefig(fig, bbox_inches="tight"); plt.close(fig)
-
-    base_plot = funil_df[funil_df["Canal de Origem"]!="TOTAL"][["Canal de Origem","Leads Recebidos"]]
-    fig = plt.figure(figsize=(10,6))
-    plt.barh(base_plot["Canal de Origem"], base_plot["Leads Recebidos"])
-    plt.xlabel("Leads"); plt.title("Leads por Canal"); plt.tight_layout()
-    pdf.savefig(fig, bbox_inches="tight"); plt.close(fig)
-
-    fig = plt.figure(figsize=(10,6))
-    conv_plot = conv_df[conv_df["Canal de Origem"]!="TOTAL"].set_index("Canal de Origem")
-    conv_plot[["% Reuniões/Leads","% Vendas/Leads","% Vendas/Reuniões"]].plot(kind="barh", ax=plt.gca())
-    plt.xlabel("%"); plt.title("Conversões por Canal"); plt.tight_layout()
-    pdf.savefig(fig, bbox_inches="tight"); plt.close(fig)
-
-    fig = plt.figure(figsize=(10,6))
-    pv = prospec_resumo_df[prospec_resumo_df["Vendedora"]!="TOTAL"].set_index("Vendedora")
-    pv[["Leads Gerados","Reuniões Agendadas","Vendas"]].plot(kind="barh", ax=plt.gca())
-    plt.title("Leads/Reuniões/Vendas por Vendedora (base filtrada)"); plt.tight_layout()
-    pdf.savefig(fig, bbox_inches="tight"); plt.close(fig)
-
-    if not prospec_funil_df.empty:
-        fig = plt.figure(figsize=(11,6))
-        # garantir colunas na ordem (inclui Finalizando)
-        cols_plot = [c for c in phase_order if c in prospec_funil_df.columns]
-        pf_plot = prospec_funil_df[prospec_funil_df["Vendedora"]!="TOTAL"].set_index("Vendedora")[cols_plot]
-        pf_plot.plot(kind="bar", stacked=False, ax=plt.gca())
-        plt.xticks(rotation=45, ha="right"); plt.title("Funil por Vendedora (base filtrada)"); plt.tight_layout()
-        pdf.savefig(fig, bbox_inches="tight"); plt.close(fig)
-
-st.download_button("⬇️ Baixar PDF", pdf_bytes.getvalue(),
-                   file_name=f"Relatorio_CRM_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
-                   mime="application/pdf")
+    st.dataframe(df[dados_cols(df)])
+tabelas = {
+    "funil_df": st.expander("Funil Comercial do Período", expanded=False),
+    "conv_df": st.expander("Taxas de Conversão por Canal", expanded=False),
+    "prospec_resumo_df": st.expander("Resumo por Vendedora", expanded=False),
+    "prospec_funil_df": st.expander("Funil Detalhado por Vendedora (base filtrada)", expanded=False),
+    "vend_origem_df": st.expander("Resumo por Vendedora × Origem", expanded=False),
+}
+
+RENDER = {"funil": [("funil", render_funil)], "vendedoras": [("vendedoras", render_vendedoras)],
+          "cubo": [("cubo", render_cubo), ("coortes", render_coortes)]}
+# enquanto espera, o placeholder é "tocado": um rerun pendente (filtro mudou) interrompe este
+# script na hora, em vez de só quando a próxima parte terminar, e cancela os jobs velhos
+espera = st.empty()
+for nome, parte in report_jobs().results(st.session_state["sessao_id"], filtro_key, partes, tick=espera.empty):
+    rel.update(parte)
+    for secao, render in RENDER[nome]:
+        with secoes[secao].container():
+            render(parte)
+    for k, exp in tabelas.items():
+        if k in parte:
+            exp.dataframe(parte[k])
+
+# ========================= Exportações (sob demanda, em segundo plano) =========================
+# Excel e PDF só são gerados quando pedidos, no mesmo pool das tabelas; o resultado fica em
+# cache por (hash do arquivo, filtros), então baixar de novo com os mesmos filtros é instantâneo.
+# Com uma página por vendedora (times grandes) as páginas do PDF são desenhadas em paralelo.
+pdf_por_vendedora = st.checkbox("PDF com uma página por vendedora", value=False)
+if st.button("📦 Preparar Excel e PDF"):
+    st.session_state["export_key"] = filtro_key
+
+if st.session_state.get("export_key") == filtro_key:
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    pdf_parte = "pdf_paginas_vendedora" if pdf_por_vendedora else "pdf"
+    downloads = {
+        "excel": (st.empty(), "⬇️ Baixar Excel", f"Relatorio_CRM_{stamp}.xlsx", EXCEL_MIME),
+        pdf_parte: (st.empty(), "⬇️ Baixar PDF", f"Relatorio_CRM_{stamp}.pdf", "application/pdf"),
+    }
+    downloads["excel"][0].caption("⏳ Gerando Excel...")
+    downloads[pdf_parte][0].caption("⏳ Gerando PDF...")
+    exports = {
+        "excel": partial(build_excel, rel),
+        pdf_parte: partial(build_pdf, rel, (d_ini, d_fim), pdf_por_vendedora),
+    }
+    espera = st.empty()
+    for nome, data in report_jobs().results(st.session_state["sessao_id"], filtro_key, exports, tick=espera.empty):
+        ph, label, file_name, mime = downloads[nome]
+        ph.download_button(label, data, file_name=file_name, mime=mime, on_click="ignore")
+elif "export_key" in st.session_state:
+    st.caption("Filtros mudaram desde a última exportação — clique em preparar de novo.")
+
+# ========================= Desempenho (debug) =========================
+if DEBUG:
+    with st.sidebar.expander("⏱️ Desempenho deste rerun", expanded=True):
+        st.dataframe(trace.frame(), hide_index=True, use_container_width=True)
+        st.caption(f"Total: {trace.record()['total_s']:.2f}s · RSS do processo: {rss_bytes() / 2**20:.0f} MB")
+        aq = crm_report.WARM_UP
+        st.caption(f"Aquecimento do processo: {aq['total_s']:.2f}s ({', '.join(e['etapa'] for e in aq['etapas'])})"
+                   if aq else "Processo sem aquecimento: imports pesados pagos no primeiro uso.")
+        st.caption("Bases em memória (compartilhadas entre sessões):")
+        st.dataframe(dataset_store().stats(), hide_index=True, use_container_width=True)
+if METRICS_LOG:
+    trace.log(METRICS_LOG)
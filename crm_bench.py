@@ -0,0 +1,206 @@
+# crm_bench.py — benchmark do motor do relatório com CSVs sintéticos
+# Exemplos:
+#   python crm_bench.py                                   # 1k, 10k e 100k linhas, ";" latin1
+#   python crm_bench.py --linhas 1000000 5000000 --separadores ";" "," --encodings utf-8 latin1
+#   python crm_bench.py --linhas 100000 --repeticoes 3 --saida bench.jsonl
+#
+# Cada etapa (ingestão, normalização, tabelas do funil, cubo diário, Excel padrão/rápido, PDF) é medida
+# separadamente; sai uma linha JSON por etapa/rodada com tempo e pico de memória, para
+# comparar execuções (ex.: antes/depois de uma mudança) com jq/pandas. O pico é o que a etapa
+# alocou (tracemalloc + pool do pyarrow), não o RSS; --sem-memoria mede só o tempo (o tracemalloc
+# deixa as etapas em Python puro, como Excel/PDF, mais lentas).
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from crm_report import (
+    bucket_lookup, map_dict,
+    ingest_stream, read_crm_csv, clean_crm_df, build_base_cube, build_report, build_daily_cube,
+    build_funil_df, build_conv_df, build_prospec_resumo_df, build_prospec_funil_df, build_vend_origem_df,
+    build_excel, build_pdf, default_period, rss_bytes,
+)
+
+# ===== Gerador de CSV sintético =====
+VENDEDORAS = ["Ana", "Bia", "Carla", "Dani", "Éva", "Fernanda", "Gabi", "Helô", "Íris", "Joana"]
+FASES_ABERTAS = ["Em contato", "Novo lead", "Qualificação", "Aguardando retorno"]
+FONTES_EXTRA = ["Evento", "Parceiro", "Outbound e-mail"]  # caem em "Outros"
+
+def _variantes(labels):
+    """Cada label normalizada em grafias que aparecem no CRM (caixa, espaços)."""
+    out = []
+    for s in sorted(labels):
+        out += [s, s.capitalize(), s.title(), f" {s.upper()} "]
+    return out
+
+def fases_sinteticas():
+    fases = _variantes(bucket_lookup)
+    # com acentos/traços como vêm do CRM
+    fases += ["Reunião Agendada", "Proposta e Negociação", "Negócio Fechado", "Aprovação da Proposta",
+              "Abaixo de R$ 500K", "Outros - Perdido", "Agendamento de Reunião"]
+    return fases + FASES_ABERTAS * 8  # boa parte da base ainda em atendimento
+
+def gerar_crm_df(n, seed=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    fases = np.array(fases_sinteticas(), dtype=object)
+    fontes = np.array(_variantes(map_dict) + FONTES_EXTRA, dtype=object)
+    inicio = np.datetime64("2024-01-01T08:00")
+    criado = pd.Series(inicio + rng.integers(0, 365 * 24 * 60, n).astype("timedelta64[m]"))
+    criado = criado.dt.strftime("%d/%m/%Y %H:%M").where(rng.random(n) > 0.01, "")
+    vend = np.array(VENDEDORAS + [""], dtype=object)
+    return pd.DataFrame({
+        "ID": np.arange(n),
+        "Fase": fases[rng.integers(0, len(fases), n)],
+        "Responsável": vend[rng.integers(0, len(vend), n)],
+        "Nome do Negócio": [f"Negócio {i}" for i in range(n)],
+        "Fonte": fontes[rng.integers(0, len(fontes), n)],
+        "Criado": criado,
+        "Motivo de perda": "",
+        "Motivo de perda.1": np.where(rng.random(n) < 0.3, "Sem orçamento", ""),
+        "Observações": "texto livre; com separador",
+    })
+
+def gerar_csv(n, path, sep=";", encoding="latin1", seed=0):
+    gerar_crm_df(n, seed).to_csv(path, sep=sep, encoding=encoding, index=False)
+    return Path(path)
+
+# ===== Medição =====
+class Medidor:
+    """Tempo de parede + pico de memória alocada durante um bloco.
+
+    Python/numpy pelo tracemalloc (pico zerado a cada bloco) e Arrow pelo pool do pyarrow
+    (amostrado numa thread). O RSS não serve: quase nunca encolhe, e toda etapa depois da
+    primeira saía com ~0 MB. Os dois picos são somados, então o total é um teto."""
+    def __init__(self, intervalo=0.005, memoria=True):
+        self.intervalo = intervalo
+        self.memoria = memoria
+        self.pico_py = self.pico_arrow = 0
+
+    def __enter__(self):
+        if self.memoria:
+            self._parar_trace = not tracemalloc.is_tracing()
+            if self._parar_trace:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.py_ini = tracemalloc.get_traced_memory()[0]
+            self.arrow_ini = self._arrow = pa.total_allocated_bytes()
+            self._parar = threading.Event()
+            self._t = threading.Thread(target=self._amostrar, daemon=True)
+            self._t.start()
+        self.t0 = time.perf_counter()
+        return self
+
+    def _amostrar(self):
+        while not self._parar.wait(self.intervalo):
+            self._arrow = max(self._arrow, pa.total_allocated_bytes())
+
+    def __exit__(self, *exc):
+        self.segundos = time.perf_counter() - self.t0
+        if self.memoria:
+            self._parar.set()
+            self._t.join()
+            self.pico_arrow = max(self._arrow, pa.total_allocated_bytes()) - self.arrow_ini
+            self.pico_py = tracemalloc.get_traced_memory()[1] - self.py_ini
+            if self._parar_trace:
+                tracemalloc.stop()
+        self.rss = rss_bytes()
+        return False
+
+def medir(etapa, fn, base, memoria=True):
+    with Medidor(memoria=memoria) as m:
+        try:
+            out, erro = fn(), None
+        except Exception as e:  # ex.: Excel acima do limite de linhas da planilha
+            out, erro = None, f"{type(e).__name__}: {e}"
+    linha = {**base, "etapa": etapa, "segundos": round(m.segundos, 4)}
+    if memoria:
+        linha.update(pico_mb=round((m.pico_py + m.pico_arrow) / 2**20, 1), pico_py_mb=round(m.pico_py / 2**20, 1),
+                     pico_arrow_mb=round(m.pico_arrow / 2**20, 1))
+    linha["rss_mb"] = round(m.rss / 2**20, 1)
+    if erro:
+        linha["erro"] = erro
+    return out, linha
+
+def bench_arquivo(path, base, etapas, memoria=True):
+    linhas = []
+    def run(etapa, fn):
+        out, linha = medir(etapa, fn, base, memoria)
+        linhas.append(linha)
+        return out
+    # caminho do app/CLI: leitura em blocos + limpeza + cubo base numa passada
+    with open(path, "rb") as f:
+        run("ingestao_blocos", lambda: ingest_stream(f))
+    # etapas isoladas: leitura inteira -> limpeza -> tabelas
+    df = run("ingestao", lambda: read_crm_csv(Path(path).read_bytes()))
+    df = run("normalizacao", lambda: clean_crm_df(df))
+    if df is None:
+        return linhas
+    run("cubo_base", lambda: build_base_cube(df))
+    def funil():
+        f = build_funil_df(df)
+        return [f, build_conv_df(f), build_prospec_resumo_df(df), build_prospec_funil_df(df), build_vend_origem_df(df)]
+    run("funil", funil)
+    run("cubo_diario", lambda: build_daily_cube(df))
+    periodo = default_period(df)
+    rel = build_report(df, *periodo, [], [], False)
+    if "excel" in etapas:
+        run("excel", lambda: build_excel(rel, rapido=False))
+        run("excel_rapido", lambda: build_excel(rel, rapido=True))
+    if "pdf" in etapas:
+        run("pdf", lambda: build_pdf(rel, periodo))
+    return linhas
+
+# ===== CLI =====
+def build_parser():
+    p = argparse.ArgumentParser(description="Mede ingestão, tabelas e exportações com CSVs sintéticos do CRM.")
+    p.add_argument("--linhas", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                   help="tamanhos (nº de linhas), de 1k a 5M")
+    p.add_argument("--separadores", nargs="+", default=[";"], choices=[";", ","])
+    p.add_argument("--encodings", nargs="+", default=["latin1"], choices=["latin1", "utf-8"])
+    p.add_argument("--repeticoes", type=int, default=1)
+    p.add_argument("--sem", nargs="*", default=[], choices=["excel", "pdf"], help="pula etapas de exportação")
+    p.add_argument("--sem-memoria", action="store_true", help="só tempo, sem o custo do tracemalloc")
+    p.add_argument("--dados", help="pasta para guardar/reaproveitar os CSVs gerados (padrão: temporária)")
+    p.add_argument("--saida", help="arquivo JSONL (padrão: stdout)")
+    p.add_argument("--seed", type=int, default=0)
+    return p
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    etapas = {"excel", "pdf"} - set(args.sem)
+    out = open(args.saida, "a", encoding="utf-8") if args.saida else sys.stdout
+    execucao = {"inicio": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                "pandas": pd.__version__, "pyarrow": pa.__version__, "host": platform.node(),
+                "tracemalloc": not args.sem_memoria}  # tempos com e sem tracemalloc não se comparam
+    with tempfile.TemporaryDirectory() as tmp:
+        dados = Path(args.dados or tmp)
+        dados.mkdir(parents=True, exist_ok=True)
+        for n in args.linhas:
+            for sep in args.separadores:
+                for enc in args.encodings:
+                    nome_sep = "pv" if sep == ";" else "virgula"
+                    path = dados / f"crm_sintetico_{n}_{nome_sep}_{enc}_s{args.seed}.csv"
+                    if not path.exists():
+                        gerar_csv(n, path, sep, enc, args.seed)
+                    for rep in range(args.repeticoes):
+                        base = {**execucao, "linhas": n, "separador": sep, "encoding": enc, "rodada": rep,
+                                "arquivo_mb": round(path.stat().st_size / 2**20, 1)}
+                        for linha in bench_arquivo(path, base, etapas, not args.sem_memoria):
+                            print(json.dumps(linha, ensure_ascii=False), file=out, flush=True)
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
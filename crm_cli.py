@@ -0,0 +1,190 @@
+# crm_cli.py — geração de relatórios CRM em lote (sem Streamlit)
+# Exemplos:
+#   python crm_cli.py export.csv --saida relatorios/
+#   python crm_cli.py jan.csv fev.csv --filtros filtros.json --workers 4
+#   python crm_cli.py export.csv --por-vendedora --de 2024-01-01 --ate 2024-01-31
+#   python crm_cli.py export.csv --pdf-por-vendedora --pdf-workers 4 --workers 1
+#
+# filtros.json é uma lista de filtros; campos omitidos usam o padrão do app
+# (período completo, todas as vendedoras/canais):
+#   [{"nome": "janeiro", "de": "2024-01-01", "ate": "2024-01-31",
+#     "vendedoras": [], "canais": ["Prospecção Ativa"], "so_prospeccao": false, "por_vendedora": true}]
+#
+# Fases/fontes vêm de taxonomia.json (ou do arquivo em CRM_TAXONOMIA).
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from functools import lru_cache
+from pathlib import Path
+
+from crm_report import (
+    load_crm_dataset, file_sha256, invalid_dates, unknown_phases, load_snapshot, snapshot_path,
+    default_period, build_report, build_excel, build_pdf, slugify,
+    DEAL_KEY, Trace, canal_prospeccao,
+)
+
+FORMATOS = ("xlsx", "pdf")
+METRICS_LOG = os.environ.get("CRM_METRICS_LOG")  # mesmas linhas JSON do app, uma por relatório
+
+def parse_spec(raw: dict) -> dict:
+    def _date(v):
+        return date.fromisoformat(v) if v else None
+    return {
+        "nome": raw.get("nome") or "relatorio",
+        "de": _date(raw.get("de")),
+        "ate": _date(raw.get("ate")),
+        "vendedoras": list(raw.get("vendedoras") or []),
+        "canais": list(raw.get("canais") or []),
+        "so_prospeccao": bool(raw.get("so_prospeccao", False)),
+        "por_vendedora": bool(raw.get("por_vendedora", False)),
+    }
+
+def expand_specs(specs, vendedoras):
+    """Abre os filtros com `por_vendedora` em um filtro por vendedora."""
+    out = []
+    for spec in specs:
+        if not spec["por_vendedora"]:
+            out.append(spec)
+            continue
+        for v in (spec["vendedoras"] or vendedoras):
+            out.append({**spec, "nome": f"{spec['nome']}_{v}", "vendedoras": [v], "por_vendedora": False})
+    return out
+
+# ===== Workers =====
+def ingest(path, snap_dir, saida, key, delta=True):
+    """Lê e limpa um CSV uma única vez (ou reaproveita o snapshot); os filtros leem o snapshot.
+
+    Com `delta` e um export anterior na pasta de snapshots, grava também as mudanças de fase em CSV."""
+    with open(path, "rb") as f:
+        file_hash = file_sha256(f)
+        ds = load_crm_dataset(f, file_hash, snap_dir, key, delta=delta)
+    df = ds["df"]
+    vendedoras = sorted(df["Responsável"].dropna().unique().tolist())
+    transicoes = None
+    if ds["delta"] is not None:
+        transicoes = Path(saida) / f"{slugify(Path(path).stem)}_transicoes.csv"
+        ds["delta"]["transicoes"].to_csv(transicoes, index=False, sep=";", encoding="utf-8-sig")
+        transicoes = str(transicoes)
+    desconhecidas = unknown_phases(df).to_dict()
+    return (str(snapshot_path(snap_dir, file_hash)), vendedoras, df.attrs.get("linhas_ignoradas", 0), transicoes,
+            desconhecidas, invalid_dates(df), df.attrs.get("aviso_incremental"))
+
+@lru_cache(maxsize=4)
+def load_ingested(snap_file):
+    # cada processo do pool mapeia cada base no máximo uma vez
+    return load_snapshot(snap_file)
+
+def run_report(snap_file, prefixo, spec, saida, formatos, pdf_por_vendedora=False, pdf_workers=1):
+    trace = Trace(origem="cli", arquivo=prefixo, filtro=spec["nome"]).start()
+    ds = load_ingested(snap_file)
+    df = ds["df"]
+    min_d, max_d = default_period(df)
+    periodo = (spec["de"] or min_d, spec["ate"] or max_d)
+    rel = build_report(df, *periodo, spec["vendedoras"], spec["canais"], spec["so_prospeccao"], ds["cubo"])
+    base = Path(saida) / f"{prefixo}_{slugify(spec['nome'])}"
+    written = []
+    if "xlsx" in formatos:
+        base.with_suffix(".xlsx").write_bytes(build_excel(rel))
+        written.append(str(base.with_suffix(".xlsx")))
+    if "pdf" in formatos:
+        base.with_suffix(".pdf").write_bytes(build_pdf(rel, periodo, pdf_por_vendedora, pdf_workers))
+        written.append(str(base.with_suffix(".pdf")))
+    if METRICS_LOG:
+        trace.log(METRICS_LOG)
+    return written
+
+# ===== CLI =====
+def build_parser():
+    p = argparse.ArgumentParser(description="Gera os relatórios Excel/PDF do CRM a partir de um ou mais CSVs.")
+    p.add_argument("csv", nargs="+", help="CSV(s) exportados do CRM")
+    p.add_argument("--saida", default="relatorios", help="pasta de saída (padrão: relatorios/)")
+    p.add_argument("--filtros", help="JSON com a lista de filtros a gerar")
+    p.add_argument("--nome", default="relatorio", help="nome do filtro montado pelas opções abaixo")
+    p.add_argument("--de", help="início do período (AAAA-MM-DD)")
+    p.add_argument("--ate", help="fim do período (AAAA-MM-DD)")
+    p.add_argument("--vendedora", action="append", default=[], help="pode repetir")
+    p.add_argument("--canal", action="append", default=[], help="pode repetir")
+    p.add_argument("--so-prospeccao", action="store_true", help=f"tabelas por vendedora só com {canal_prospeccao}")
+    p.add_argument("--por-vendedora", action="store_true", help="um relatório por vendedora")
+    p.add_argument("--formatos", nargs="+", choices=FORMATOS, default=list(FORMATOS))
+    p.add_argument("--workers", type=int, default=os.cpu_count(), help="processos em paralelo")
+    p.add_argument("--pdf-por-vendedora", action="store_true", help="no PDF, uma página extra por vendedora")
+    p.add_argument("--pdf-workers", type=int, default=1,
+                   help="processos para desenhar as páginas de cada PDF (padrão: 1, os relatórios já rodam em paralelo)")
+    p.add_argument("--snapshots", default=os.environ.get("CRM_SNAPSHOT_DIR"),
+                   help="pasta de snapshots Feather reaproveitados entre execuções (padrão: $CRM_SNAPSHOT_DIR); "
+                        "com ela os CSVs são lidos na ordem dada e cada um gera as transições vs. o anterior")
+    p.add_argument("--chave", default=",".join(DEAL_KEY),
+                   help="colunas que identificam um negócio entre exports, separadas por vírgula "
+                        f"(padrão: {','.join(DEAL_KEY)})")
+    return p
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.filtros:
+        specs = [parse_spec(s) for s in json.loads(Path(args.filtros).read_text(encoding="utf-8"))]
+    else:
+        specs = [parse_spec({
+            "nome": args.nome, "de": args.de, "ate": args.ate, "vendedoras": args.vendedora,
+            "canais": args.canal, "so_prospeccao": args.so_prospeccao, "por_vendedora": args.por_vendedora,
+        })]
+    Path(args.saida).mkdir(parents=True, exist_ok=True)
+    key = [c.strip() for c in args.chave.split(",") if c.strip()]
+
+    falhas = 0
+    with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        snap_dir = args.snapshots or tmp
+        # delta só com --snapshots explícito, e então na ordem dada (cada CSV contra o anterior);
+        # sem ele os CSVs são lidos em paralelo, sem comparar com o que outro processo gravou
+        delta = bool(args.snapshots)
+
+        def ingested():
+            if delta:
+                for path in args.csv:
+                    yield path, pool.submit(ingest, path, snap_dir, args.saida, key, True)
+            else:
+                futs = {pool.submit(ingest, path, snap_dir, args.saida, key, False): path for path in args.csv}
+                for fut in as_completed(futs):
+                    yield futs[fut], fut
+
+        jobs = {}
+        for path, fut in ingested():
+            try:
+                snap_file, vendedoras, ignoradas, transicoes, desconhecidas, datas_invalidas, aviso = fut.result()
+            except Exception as e:
+                print(f"[erro] {path}: {e}", file=sys.stderr)
+                falhas += 1
+                continue
+            if aviso:
+                print(f"[aviso] {path}: {aviso}", file=sys.stderr)
+            if ignoradas:
+                print(f"[aviso] {path}: {ignoradas} linha(s) malformada(s) ignorada(s)", file=sys.stderr)
+            if datas_invalidas:
+                print(f"[aviso] {path}: {datas_invalidas} linha(s) com data de criação não reconhecida (ficam sem data)",
+                      file=sys.stderr)
+            if desconhecidas:
+                fases = ", ".join(f"{f} ({n})" for f, n in desconhecidas.items())
+                print(f"[aviso] {path}: fase(s) fora da taxonomia contadas como Em Atendimento: {fases}", file=sys.stderr)
+            if transicoes:
+                print(transicoes)
+            prefixo = slugify(Path(path).stem)
+            for spec in expand_specs(specs, vendedoras):
+                jobs[pool.submit(run_report, snap_file, prefixo, spec, args.saida, args.formatos,
+                                 args.pdf_por_vendedora, args.pdf_workers)] = (path, spec["nome"])
+        for fut in as_completed(jobs):
+            path, nome = jobs[fut]
+            try:
+                for out in fut.result():
+                    print(out)
+            except Exception as e:
+                print(f"[erro] {path} / {nome}: {e}", file=sys.stderr)
+                falhas += 1
+    return 1 if falhas else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
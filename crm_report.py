@@ -0,0 +1,1683 @@
+# crm_report.py — motor do Relatório CRM (sem Streamlit)
+# Ingestão, funil, séries diárias e exportações usados pelo app.py e pelo crm_cli.py.
+
+import numpy as np
+import pandas as pd
+import unicodedata
+import codecs
+import csv
+import contextvars
+import hashlib
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED, CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait,
+)
+from contextlib import contextmanager
+from functools import lru_cache
+from io import BytesIO, StringIO
+from datetime import date, datetime
+from pathlib import Path
+from pandas.tseries.api import guess_datetime_format
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+
+# ========================= Helpers =========================
+def strip_accents(s: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
+
+@lru_cache(maxsize=4096)
+def norm_phase(s):
+    if pd.isna(s):
+        return ""
+    s = str(s).strip().lower()
+    s = strip_accents(s)
+    s = (s.replace("r$", "")
+           .replace("  ", " ").replace("–", "-").replace("—", "-")
+           .replace(" -", "").replace("-", " "))
+    return " ".join(s.split())
+
+@lru_cache(maxsize=4096)
+def norm_text(x):
+    return strip_accents(str(x).strip().lower()) if pd.notna(x) else ""
+
+def map_distinct(series, func, categories=None):
+    """Aplica `func` uma vez por valor distinto e devolve um Categorical alinhado às linhas."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, uniques = pd.factorize(series)
+    # o nulo (código -1) fica na última posição, então codes == -1 já indexa o resultado certo
+    mapped = [func(u) for u in uniques] + [func(None)]
+    if categories is None:
+        pos, categories = pd.factorize(pd.Index(mapped, dtype=object))
+    else:
+        pos = pd.Index(categories).get_indexer(mapped)
+    return pd.Categorical.from_codes(pos[codes], categories=categories)
+
+def pct(a, b):
+    return round((a / b * 100) if b else 0, 2)
+
+def slugify(s) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", strip_accents(str(s)).lower()).strip("_") or "sem_nome"
+
+def default_period(df):
+    """Período padrão do filtro: do primeiro ao último `Criado` válido."""
+    if df["Criado"].notna().any():
+        return pd.to_datetime(df["Criado"].min()).date(), pd.to_datetime(df["Criado"].max()).date()
+    return date.today(), date.today()
+
+# ========================= Instrumentação =========================
+# As etapas pesadas rodam dentro de `stage(nome)`: com um Trace ativo (por rerun do app ou
+# execução do CLI) registram tempo de parede, linhas e delta de RSS; sem Trace custam só um lookup.
+_trace = contextvars.ContextVar("crm_trace", default=None)
+# Jobs em segundo plano (ReportJobs) carregam um evento: cancelado, o job para na próxima etapa
+_cancel = contextvars.ContextVar("crm_cancel", default=None)
+
+class JobCancelled(Exception):
+    """Job descartado antes de terminar (os filtros mudaram)."""
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+class Trace:
+    """Etapas medidas em um rerun; `start()` o torna o destino de `stage` no contexto atual."""
+    def __init__(self, **meta):
+        self.meta = meta
+        self.stages = []
+        self.t0 = time.perf_counter()
+
+    def start(self):
+        _trace.set(self)
+        return self
+
+    def frame(self) -> pd.DataFrame:
+        """Etapas somadas por nome (leitura em blocos, p.ex., aparece uma vez por bloco)."""
+        if not self.stages:
+            return pd.DataFrame(columns=["etapa", "chamadas", "segundos", "linhas", "mem_mb"])
+        d = pd.DataFrame(self.stages).astype({"linhas": "Int64"})
+        return (d.groupby("etapa", sort=False)
+                 .agg(chamadas=("segundos", "size"), segundos=("segundos", "sum"),
+                      linhas=("linhas", lambda x: x.sum(min_count=1)), mem_mb=("mem_mb", "sum"))
+                 .reset_index())
+
+    def record(self) -> dict:
+        return {"ts": datetime.now().isoformat(timespec="seconds"), **self.meta,
+                "total_s": round(time.perf_counter() - self.t0, 4), "etapas": self.stages}
+
+    def log(self, dest):
+        """Grava uma linha JSON (arquivo em append, ou "-" para stderr)."""
+        line = json.dumps(self.record(), ensure_ascii=False, default=str)
+        if dest == "-":
+            print(line, file=sys.stderr, flush=True)
+        else:
+            with open(dest, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+@contextmanager
+def stage(nome, linhas=None):
+    """Mede o bloco no Trace ativo; o dict devolvido aceita `linhas` conhecidas só no fim."""
+    ev = _cancel.get()
+    if ev is not None and ev.is_set():
+        raise JobCancelled(nome)
+    tr = _trace.get()
+    info = {"linhas": linhas}
+    if tr is None:
+        yield info
+        return
+    rss0, t0 = rss_bytes(), time.perf_counter()
+    try:
+        yield info
+    finally:
+        tr.stages.append({"etapa": nome, "segundos": round(time.perf_counter() - t0, 4),
+                          "linhas": info["linhas"], "mem_mb": round((rss_bytes() - rss0) / 2**20, 1)})
+
+# ========================= Colunas / Canais =========================
+expected = {
+    "Fase": ["Fase"],
+    "Responsável": ["Responsável", "Responsavel"],
+    "Nome do Negócio": ["Nome do Negócio", "Nome do negocio", "Nome do negócio"],
+    "Fonte": ["Fonte"],
+    "Criado": ["Criado", "Data de criação", "Data de criacao"],
+    "Motivo de perda": ["Motivo de perda.1", "Motivo de perda_1", "Motivo de perda 1"],
+}
+
+# Colunas de baixa cardinalidade lidas já como categóricas (dicionário no Arrow)
+CATEGORY_COLS = ["Fase", "Responsável", "Fonte", "Motivo de perda"]
+
+# Teto de memória do cache de tabelas por filtro (compartilhado entre sessões do processo)
+REPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Teto das bases limpas compartilhadas (DatasetStore); acima dele saem primeiro as ociosas
+DATASET_MAX_BYTES = 512 * 1024 * 1024
+
+# Mesmos valores que o pandas.read_csv trata como nulo por padrão
+CSV_NA_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                 "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+# Ordem das colunas de fase nas tabelas (bucket de cada linha; fase fora da taxonomia cai em "Em Atendimento")
+fases_cols = [
+    "Sem retorno","Sem Interesse","Fora do Perfil","Outros/Perdido","Abaixo de R$500K",
+    "Agendando Reunião","Reuniões Agendadas","Proposta e Negociação","Finalizando Venda","Negócio Fechado","Em Atendimento"
+]
+
+# ===== Taxonomia: fase -> bucket, Fonte -> Canal =====
+# Vem de taxonomia.json (ou do arquivo em CRM_TAXONOMIA: .json, ou .yaml/.yml com PyYAML) e é
+# compilada na importação em dois dicionários texto normalizado -> destino, aplicados uma vez
+# por valor distinto da coluna (map_distinct). O id da taxonomia entra na chave dos snapshots.
+TAXONOMY_PATH = Path(os.environ.get("CRM_TAXONOMIA") or Path(__file__).with_name("taxonomia.json"))
+
+def compile_taxonomy(raw: dict) -> dict:
+    fases, canais = {}, {}
+    for bucket, labels in raw["fases"].items():
+        if bucket not in fases_cols:
+            raise ValueError(f"Taxonomia: fase '{bucket}' não existe (use uma de: {', '.join(fases_cols)}).")
+        for label in labels:
+            if fases.setdefault(norm_phase(label), bucket) != bucket:
+                raise ValueError(f"Taxonomia: '{label}' está em '{fases[norm_phase(label)]}' e em '{bucket}'.")
+    for canal, fontes in raw["canais"].items():
+        for fonte in fontes:
+            if canais.setdefault(norm_text(fonte), canal) != canal:
+                raise ValueError(f"Taxonomia: fonte '{fonte}' está em '{canais[norm_text(fonte)]}' e em '{canal}'.")
+    padrao = raw.get("canal_padrao", "Outros")
+    prospec = raw.get("canal_prospeccao", "Prospecção Ativa")
+    ordem = list(raw.get("canal_ordem") or [])
+    ordem += [c for c in dict.fromkeys([*raw["canais"], prospec, padrao]) if c not in ordem]  # canal fora da ordem sumiria do funil
+    tax = {"fases": fases, "canais": canais, "canal_padrao": padrao, "canal_prospeccao": prospec, "canal_ordem": ordem,
+           "canais_mkt": list(raw.get("canais_mkt") or [])}
+    tax["id"] = hashlib.sha256(json.dumps(tax, sort_keys=True).encode()).hexdigest()[:8]
+    return tax
+
+def load_taxonomy(path=TAXONOMY_PATH) -> dict:
+    path = Path(path)
+    text = path.read_text(encoding="utf-8")
+    if path.suffix.lower() in (".yaml", ".yml"):
+        try:
+            import yaml  # opcional, só para quem prefere manter a taxonomia em YAML
+        except ImportError as e:
+            raise ImportError(f"Taxonomia {path.name} em YAML requer o PyYAML (pip install PyYAML).") from e
+        return compile_taxonomy(yaml.safe_load(text))
+    return compile_taxonomy(json.loads(text))
+
+TAXONOMIA = load_taxonomy()
+bucket_lookup = TAXONOMIA["fases"]
+map_dict = TAXONOMIA["canais"]
+canal_padrao = TAXONOMIA["canal_padrao"]
+canal_prospeccao = TAXONOMIA["canal_prospeccao"]
+canal_ordem = TAXONOMIA["canal_ordem"]
+mkt_canais = TAXONOMIA["canais_mkt"]
+
+# Paleta e ordem fixa das fases (inclui Finalizando)
+phase_order = [
+    "Em Atendimento",
+    "Agendando Reunião",
+    "Reuniões Agendadas",
+    "Proposta e Negociação",
+    "Finalizando Venda",        # NOVA
+    "Negócio Fechado",
+    "Abaixo de R$500K",
+    "Fora do Perfil",
+    "Sem Interesse",
+    "Sem retorno",
+    "Outros/Perdido",
+]
+# amarelo -> verdes -> vermelhos (adicionamos 1 verde para "Finalizando Venda")
+phase_colors = [
+    "#fbbf24",  # Em Atendimento (amarelo)
+    "#86efac",  # Agendando
+    "#4ade80",  # Reuniões agendadas
+    "#22c55e",  # Proposta
+    "#16a34a",  # Finalizando (verde mais escuro)
+    "#0ea5a8",  # Negócio Fechado (verde/teal)
+    "#fca5a5",  # Abaixo de 500k
+    "#f87171",  # Fora do Perfil
+    "#dc2626",  # Sem Interesse
+    "#991b1b",  # Sem retorno
+    "#ef4444",  # Outros/Perdido
+]
+phase_rank = {n:i for i,n in enumerate(phase_order)}
+
+# ========================= Ingestão =========================
+def resolve_columns(columns):
+    colmap = {}
+    for wanted, cands in expected.items():
+        for c in cands:
+            if c in columns:
+                colmap[wanted] = c
+                break
+    missing = [k for k in expected if k not in colmap]
+    if missing:
+        raise KeyError(f"Faltam colunas no CSV: {missing}\nColunas recebidas: {list(columns)}")
+    return colmap
+
+def sniff_csv(raw: bytes, sample_bytes: int = 64 * 1024):
+    """Encoding e separador a partir de um prefixo limitado (sem decodificar o arquivo todo)."""
+    head = raw[:sample_bytes]
+    enc_used = "utf-8"
+    try:
+        # decoder incremental tolera um caractere multibyte cortado no fim do prefixo
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=len(head) == len(raw))
+    except UnicodeDecodeError:
+        enc_used = "latin1"
+    sample = "\n".join(head.decode(enc_used, errors="ignore").splitlines()[:20])
+    delim = ";" if sample.count(";") >= sample.count(",") else ","
+    return enc_used, delim
+
+def csv_header(head: bytes, enc: str, delim: str):
+    # só linhas inteiras: um prefixo cortado no meio de um caractere utf-8 não decodifica
+    head = head[:head.rfind(b"\n") + 1] or head
+    header = pd.read_csv(BytesIO(head), sep=delim, encoding=enc, nrows=0).columns.tolist()
+    return header, resolve_columns(header)
+
+def csv_options(header, colmap, enc, delim, skipped, block_size=None, short=None):
+    """Opções do pyarrow.csv comuns à leitura inteira e à leitura em blocos.
+
+    Como o on_bad_lines="skip" do pandas, só linha com campos a mais é ignorada (`skipped`); linha
+    com campos a menos vai para `short` (texto) e é relida completada com nulos (short_rows_table)."""
+    def skip_bad_line(row):
+        if row.actual_columns < row.expected_columns:
+            short.append(row.text)
+        else:
+            skipped.append(row.number)
+        return "skip"
+    read_opts = pacsv.ReadOptions(column_names=header, skip_rows=1, encoding=enc)
+    if block_size:
+        read_opts.block_size = block_size
+    # pyarrow confere o nº de campos mesmo lendo só as colunas usadas (o engine C não)
+    parse_opts = pacsv.ParseOptions(delimiter=delim, newlines_in_values=True, invalid_row_handler=skip_bad_line)
+    convert_opts = pacsv.ConvertOptions(
+        include_columns=[colmap[k] for k in expected],
+        column_types={colmap[k]: pa.dictionary(pa.int32(), pa.string()) if k in CATEGORY_COLS else pa.string()
+                      for k in expected},
+        strings_can_be_null=True, null_values=CSV_NA_VALUES,
+    )
+    return read_opts, parse_opts, convert_opts
+
+def short_rows_table(texts, header, colmap, delim) -> pa.Table:
+    """Linhas com campos a menos no fim, completadas com nulos (o pandas faz isso sozinho)."""
+    pos = {h: i for i, h in enumerate(header)}
+    rows = [next(csv.reader(StringIO(t), delimiter=delim), []) for t in texts]
+    cols = {}
+    for k in expected:
+        i = pos[colmap[k]]
+        vals = [r[i] if i < len(r) and r[i] not in CSV_NA_VALUES else None for r in rows]
+        arr = pa.array(vals, pa.string())
+        cols[colmap[k]] = arr.dictionary_encode().cast(pa.dictionary(pa.int32(), pa.string())) if k in CATEGORY_COLS else arr
+    return pa.table(cols)
+
+def arrow_string_dtype(t):
+    return pd.StringDtype("pyarrow") if t in (pa.string(), pa.large_string()) else None
+
+def arrow_to_crm(table) -> pd.DataFrame:
+    # colunas-dicionário viram categóricas direto do Arrow; texto livre fica em buffers Arrow
+    df = table.to_pandas(types_mapper=arrow_string_dtype)
+    df.columns = list(expected.keys())
+    for col in CATEGORY_COLS:
+        # categorias em ordem alfabética: groupby/tabelas por vendedora saem na mesma ordem de antes
+        df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+    return df
+
+def parse_crm_csv(raw: bytes, enc: str, delim: str) -> pd.DataFrame:
+    header, colmap = csv_header(raw, enc, delim)
+    skipped, short = [], []
+    table = pacsv.read_csv(BytesIO(raw), *csv_options(header, colmap, enc, delim, skipped, short=short))
+    if short:  # linhas curtas vão para o fim, como na leitura em blocos
+        table = pa.concat_tables([table, short_rows_table(short, header, colmap, delim)])
+    df = arrow_to_crm(table)
+    df.attrs["linhas_ignoradas"] = len(skipped)
+    return df
+
+def read_crm_csv(raw: bytes) -> pd.DataFrame:
+    enc_used, delim = sniff_csv(raw)
+    try:
+        return parse_crm_csv(raw, enc_used, delim)
+    except (UnicodeDecodeError, pa.ArrowInvalid):
+        if enc_used != "utf-8":
+            raise
+        # prefixo era utf-8 válido mas o resto do arquivo não
+        return parse_crm_csv(raw, "latin1", delim)
+
+# ===== Datas =====
+# Exports repetem muito o mesmo "Criado" e misturam "dd/mm/aaaa" com "dd/mm/aaaa HH:MM":
+# cada string distinta é convertida uma vez, com formatos explícitos descobertos numa amostra
+# (adivinhar pelo 1º valor fazia as linhas do outro formato virarem NaT sem aviso).
+DATE_SAMPLE = 200      # strings distintas examinadas por rodada de descoberta de formatos
+DATE_MAX_FORMATS = 8   # formatos tentados por chamada, no máximo
+
+def detect_date_formats(values, skip=()) -> list:
+    """Formatos (strftime) de uma amostra espaçada de `values`, do mais ao menos frequente."""
+    step = max(1, len(values) // DATE_SAMPLE)
+    counts = {}
+    for v in values[::step][:DATE_SAMPLE]:
+        f = guess_datetime_format(v, dayfirst=not v[:4].isdigit())  # ISO (ano na frente) não é dia/mês
+        if f and f not in skip:
+            counts[f] = counts.get(f, 0) + 1
+    return sorted(counts, key=counts.get, reverse=True)
+
+def strptime_strict(vals, fmt) -> np.ndarray:
+    """datetime64[ns] de `vals` (pa.StringArray) num formato explícito; NaT onde não converte.
+
+    O Arrow converte em C, mas é leniente: dia que não existe "rola" para o dia 1-3 do mês
+    seguinte (31/02 -> 02/03) e ano curto vira ano < 1000. Esses casos são conferidos formatando
+    de volta, e o que não volta idêntico (ou dia sem zero à esquerda) passa pelo pandas, que é
+    estrito. Ano fora do intervalo do datetime64[ns] (~1677-2262, p.ex. 3024 digitado) também vai
+    para o pandas (e vira NaT) em vez de estourar na conversão. Formato que o Arrow não entende
+    (nada converte) vai todo para o pandas."""
+    d = pc.strptime(vals, format=fmt, unit="s", error_is_null=True)
+    if d.null_count == len(d):
+        return pd.to_datetime(vals.to_numpy(zero_copy_only=False), format=fmt, errors="coerce").to_numpy()
+    ano = pc.year(d)
+    fora = pc.fill_null(pc.or_(pc.less(ano, pd.Timestamp.min.year + 1), pc.greater(ano, pd.Timestamp.max.year - 1)), False)
+    out = pc.if_else(fora, pa.scalar(None, d.type), d).to_numpy(zero_copy_only=False).astype("datetime64[ns]")
+    susp = pc.fill_null(pc.or_(pc.less_equal(pc.day(d), 3), fora), False)
+    idx = np.flatnonzero(susp.to_numpy(zero_copy_only=False))
+    same = pc.equal(pc.strftime(d.take(idx), format=fmt), vals.take(idx)).to_numpy(zero_copy_only=False)
+    same &= ~fora.to_numpy(zero_copy_only=False)[idx]
+    rest = idx[~same]
+    if len(rest):
+        out[rest] = pd.to_datetime(vals.take(rest).to_numpy(zero_copy_only=False), format=fmt,
+                                   errors="coerce").to_numpy()
+    return out
+
+def parse_criado(s, fmts=None):
+    """Datas do CRM -> (datas, formatos usados, máscara de inválidas).
+
+    `fmts` são formatos já conhecidos (p.ex. do bloco anterior), tentados primeiro; o que sobrar
+    sem data ganha formatos descobertos numa amostra e, por fim, a conversão data a data do pandas
+    ("mixed"). Inválida = preenchida mas que nem assim vira data (fica NaT)."""
+    fmts = [f for f in ([fmts] if isinstance(fmts, str) else fmts or []) if f != "mixed"]
+    arr = pa.array(s, pa.string(), from_pandas=True)
+    if isinstance(arr, pa.ChunkedArray):  # coluna lida pelo Arrow em pedaços
+        arr = arr.combine_chunks()
+    enc = pc.dictionary_encode(arr)
+    codes = pc.fill_null(enc.indices, len(enc.dictionary)).to_numpy(zero_copy_only=False)  # nulo -> posição extra
+    vals = pa.concat_arrays([pc.utf8_trim_whitespace(enc.dictionary), pa.array([""])])
+    out = np.full(len(vals), np.datetime64("NaT"), dtype="datetime64[ns]")
+    todo = pc.not_equal(vals, "").to_numpy(zero_copy_only=False)  # nulos e vazios ficam sem data, sem contar como inválidos
+    fila, tentados = list(fmts), set()
+    while todo.any() and len(tentados) < DATE_MAX_FORMATS:
+        if not fila:
+            fila = detect_date_formats(vals.filter(todo).to_pylist(), tentados)
+            if not fila:
+                break
+        f = fila.pop(0)
+        tentados.add(f)
+        idx = np.flatnonzero(todo)
+        d = strptime_strict(vals.take(idx), f)
+        ok = ~np.isnat(d)
+        out[idx[ok]], todo[idx[ok]] = d[ok], False
+        if ok.any() and f not in fmts:
+            fmts.append(f)
+    if todo.any():
+        # sem formato reconhecível (p.ex. ano com 2 dígitos): data a data, como o pandas faz sozinho
+        idx = np.flatnonzero(todo)
+        d = pd.to_datetime(vals.take(idx).to_numpy(zero_copy_only=False), format="mixed", dayfirst=True,
+                           errors="coerce").to_numpy()
+        ok = ~np.isnat(d)
+        out[idx[ok]], todo[idx[ok]] = d[ok], False
+        if ok.any():
+            fmts.append("mixed")
+    return pd.Series(out[codes], index=s.index, name=s.name), fmts, todo[codes]
+
+def row_hash(df) -> np.ndarray:
+    """Hash do conteúdo bruto de cada linha (colunas do CSV) — identifica linhas idênticas entre exports."""
+    return pd.util.hash_pandas_object(df[list(expected)], index=False).to_numpy()
+
+def clean_crm_df(df: pd.DataFrame, date_fmts=None) -> pd.DataFrame:
+    n = len(df)
+    with stage("hash_linhas", n):
+        df["_row_hash"] = row_hash(df)
+    with stage("datas", n):
+        df["Criado"], df.attrs["formato_data"], df["_data_invalida"] = parse_criado(df["Criado"], date_fmts)
+    with stage("norm_phase", n):
+        df["_fase_norm"] = map_distinct(df["Fase"], norm_phase)
+    with stage("canal", n):
+        df["Canal de Origem"] = map_distinct(df["Fonte"], lambda x: map_dict.get(norm_text(x), canal_padrao))
+    with stage("bucket", n):
+        df["_bucket"] = map_distinct(
+            df["_fase_norm"], lambda f: bucket_lookup.get(f, "Em Atendimento"), categories=fases_cols)
+    return df
+
+def invalid_dates(df) -> int:
+    """Linhas com Criado preenchido em formato não reconhecido (sem data: ficam fora do período)."""
+    return int(df["_data_invalida"].sum()) if "_data_invalida" in df.columns else 0
+
+def unknown_phases(df) -> pd.Series:
+    """Fases (como vieram no CSV) fora da taxonomia, com nº de linhas; contam como "Em Atendimento"."""
+    fase = df["Fase"] if isinstance(df["Fase"].dtype, pd.CategoricalDtype) else df["Fase"].astype("category")
+    cats = fase.cat.categories
+    codes = fase.cat.codes.to_numpy()
+    n = pd.Series(np.bincount(codes[codes >= 0], minlength=len(cats)), index=cats.astype(str), name="Linhas")
+    fora = np.array([norm_phase(c) not in bucket_lookup and norm_phase(c) != "" for c in cats], dtype=bool)
+    return n[fora & (n.to_numpy() > 0)].sort_values(ascending=False).rename_axis("Fase")
+
+def concat_clean(frames) -> pd.DataFrame:
+    """Concatena blocos já limpos sem perder as categóricas.
+
+    Colunas do CSV ficam com categorias ordenadas; as derivadas, na ordem de aparição.
+    Ajusta as categorias dos próprios blocos (in place) antes do concat."""
+    frames = list(frames)
+    for col in CATEGORY_COLS + ["_fase_norm", "Canal de Origem"]:
+        cats = frames[0][col].cat.categories
+        for f in frames[1:]:
+            cats = cats.append(f[col].cat.categories.difference(cats, sort=False))
+        if col in CATEGORY_COLS:
+            cats = pd.Index(sorted(cats))
+        for f in frames:
+            f[col] = f[col].cat.set_categories(cats)
+    return pd.concat(frames, ignore_index=True)
+
+# ========================= Ingestão em blocos =========================
+# O CSV é lido (do disco ou do upload) em blocos de CHUNK_BYTES: cada bloco é limpo e somado
+# ao cubo base na hora; só a base limpa (colunas usadas) fica retida, sem cópias decodificadas
+# do arquivo inteiro. O pico de memória é bloco + base retida + cubo.
+CHUNK_BYTES = 16 * 1024 * 1024
+SNIFF_BYTES = 64 * 1024
+
+def iter_crm_chunks(f, enc, delim, skipped, block_size=CHUNK_BYTES):
+    f.seek(0)
+    header, colmap = csv_header(f.read(SNIFF_BYTES), enc, delim)
+    f.seek(0)
+    short = []
+    reader = pacsv.open_csv(f, *csv_options(header, colmap, enc, delim, skipped, block_size, short))
+    while True:
+        with stage("leitura_csv") as m:
+            batch = next(reader, None)
+            chunk = None if batch is None else arrow_to_crm(pa.Table.from_batches([batch]))
+            m["linhas"] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        yield chunk
+    if short:  # linhas com campos a menos, completadas, num bloco final
+        yield arrow_to_crm(short_rows_table(short, header, colmap, delim))
+
+
+def stream_crm(f, consume, block_size=CHUNK_BYTES):
+    """Chama consume(blocos, ignoradas) com os blocos brutos de `f`; refaz em latin1 se o utf-8 falhar no meio."""
+    f.seek(0)
+    enc_used, delim = sniff_csv(f.read(SNIFF_BYTES + 1), SNIFF_BYTES)
+    skipped = []
+    try:
+        return consume(iter_crm_chunks(f, enc_used, delim, skipped, block_size), skipped)
+    except (UnicodeDecodeError, pa.ArrowInvalid):
+        if enc_used != "utf-8":
+            raise
+        # prefixo era utf-8 válido mas o resto do arquivo não
+        skipped = []
+        return consume(iter_crm_chunks(f, "latin1", delim, skipped, block_size), skipped)
+
+def fold_crm_chunks(chunks, skipped) -> dict:
+    frames, cubes, fmts = [], [], None
+    for chunk in chunks:
+        chunk = clean_crm_df(chunk, fmts)
+        fmts = chunk.attrs["formato_data"]
+        with stage("cubo_base", len(chunk)):
+            cubes.append(build_base_cube(chunk))
+        frames.append(chunk)
+    if not frames:
+        vazio = {c: pa.array([], pa.dictionary(pa.int32(), pa.string()) if c in CATEGORY_COLS else pa.string())
+                 for c in expected}
+        df = clean_crm_df(arrow_to_crm(pa.table(vazio)))
+    else:
+        df = concat_clean(frames)
+    df.attrs = {"linhas_ignoradas": len(skipped), "formato_data": fmts}
+    return {"df": df, "cubo": merge_cubes(cubes) if cubes else build_base_cube(df), "delta": None}
+
+def ingest_stream(f, block_size=CHUNK_BYTES) -> dict:
+    """Mesmo resultado de clean_crm_df(read_crm_csv(raw)) + cubo, lendo `f` (arquivo binário) em blocos."""
+    return stream_crm(f, fold_crm_chunks, block_size)
+
+def file_sha256(f) -> str:
+    f.seek(0)
+    h = hashlib.sha256()
+    for block in iter(lambda: f.read(1024 * 1024), b""):
+        h.update(block)
+    return h.hexdigest()
+
+# ========================= Cubo base + ingestão incremental =========================
+# Cubo base = leads por Dia x Responsável x Canal x fase da base inteira (Dia NaT incluído).
+# Um export novo é comparado ao anterior linha a linha (hash do conteúdo), bloco a bloco:
+# só as linhas novas/alteradas são limpas, e o cubo recebe apenas a diferença.
+CUBE_LEVELS = ["Dia", "Responsável", "Canal de Origem", "_bucket"]
+DEAL_KEY = ["Nome do Negócio", "Criado", "Responsável"]
+DELTA_MIN_OVERLAP = 0.5  # abaixo disso o export "anterior" é outra base: ingestão completa
+
+def cube_counts(d, weights=None) -> pd.Series:
+    dia = d["Criado"].dt.floor("D").rename("Dia")
+    g = d.assign(_n=1 if weights is None else weights).groupby(
+        [dia, "Responsável", "Canal de Origem", "_bucket"], observed=True, dropna=False)["_n"]
+    return g.sum().astype("int64")
+
+def build_base_cube(df) -> pd.Series:
+    return cube_counts(df)
+
+def update_base_cube(cube, prev, cur) -> pd.Series:
+    """Cubo de `cur` a partir do de `prev`: soma a diferença de multiplicidade de cada linha."""
+    diff = cur["_row_hash"].value_counts().sub(prev["_row_hash"].value_counts(), fill_value=0)
+    diff = diff[diff != 0]
+    if diff.empty:
+        return cube
+    rep = pd.concat([
+        cur[cur["_row_hash"].isin(diff.index)].drop_duplicates("_row_hash"),
+        prev[prev["_row_hash"].isin(diff.index)].drop_duplicates("_row_hash"),
+    ]).drop_duplicates("_row_hash")
+    delta = cube_counts(rep, rep["_row_hash"].map(diff).to_numpy())
+    return merge_cubes([cube, delta])
+
+def merge_cubes(cubes) -> pd.Series:
+    """Soma cubos (blocos de leitura ou deltas); contagens zeradas saem."""
+    # concat + groupby (e não Series.add): chaves com vendedora/dia nulos precisam casar
+    out = pd.concat(cubes).groupby(level=CUBE_LEVELS, observed=True, dropna=False).sum()
+    return out[out != 0].astype("int64")
+
+def filter_cube(cube, d_ini, d_fim, sel_vendedoras, sel_canais, com_datas=True) -> pd.Series:
+    """Recorte do cubo base equivalente a build_daily_cube(base filtrada)."""
+    dias = cube.index.get_level_values("Dia")
+    mask = dias.notna()
+    if com_datas:
+        mask &= (dias >= pd.Timestamp(d_ini)) & (dias <= pd.Timestamp(d_fim))
+    if sel_vendedoras:
+        mask &= cube.index.get_level_values("Responsável").isin(sel_vendedoras)
+    if sel_canais:
+        mask &= cube.index.get_level_values("Canal de Origem").isin(sel_canais)
+    return cube[mask]
+
+def phase_transitions(prev, cur, key=DEAL_KEY) -> pd.DataFrame:
+    """Negócios (pela chave) presentes nos dois exports cuja fase mudou."""
+    cols = ["Fase", "_bucket"]
+    a = prev.drop_duplicates(key, keep="last").set_index(key)[cols]
+    b = cur.drop_duplicates(key, keep="last").set_index(key)[cols]
+    j = a.join(b, how="inner", lsuffix=" anterior", rsuffix=" atual")
+    mudou = j["Fase anterior"].astype("string").fillna("").ne(j["Fase atual"].astype("string").fillna(""))
+    j = j[mudou.to_numpy()].rename(columns={"_bucket anterior": "Etapa anterior", "_bucket atual": "Etapa atual"})
+    for c in ("Etapa anterior", "Etapa atual"):
+        j[c] = j[c].astype("string")
+    return j.reset_index()
+
+def delta_crm_chunks(chunks, skipped, prev: dict, key=DEAL_KEY):
+    """Limpa só as linhas que não existiam no export anterior (`prev` = dataset limpo), bloco a bloco.
+
+    Devolve o dataset (df, cubo, delta) ou None se os exports quase não se sobrepõem."""
+    prev_df = prev["df"]
+    h_prev = prev_df["_row_hash"].to_numpy()
+    first = ~pd.Index(h_prev).duplicated()
+    lookup, src = pd.Index(h_prev[first]), np.flatnonzero(first)
+    fmts = prev_df.attrs.get("formato_data")
+    frames, n_hit, n_rows = [], 0, 0
+    for cur in chunks:
+        pos = lookup.get_indexer(row_hash(cur))
+        hit = pos >= 0
+        reused = prev_df.take(src[pos[hit]])
+        fresh = clean_crm_df(cur[~hit].reset_index(drop=True), fmts)
+        fmts = fresh.attrs["formato_data"]
+        part = concat_clean([reused, fresh[reused.columns]])
+        order = np.concatenate([np.flatnonzero(hit), np.flatnonzero(~hit)])
+        frames.append(part.take(np.argsort(order, kind="stable")))
+        n_hit += int(hit.sum())
+        n_rows += len(cur)
+    if not n_rows or n_hit / n_rows < DELTA_MIN_OVERLAP:
+        return None
+    df = concat_clean(frames)
+    df.attrs = {"linhas_ignoradas": len(skipped), "formato_data": fmts}
+
+    a = pd.MultiIndex.from_frame(prev_df[key]).unique()
+    b = pd.MultiIndex.from_frame(df[key]).unique()
+    delta = {
+        "base": prev_df.attrs.get("file_hash"),
+        "linhas_reaproveitadas": n_hit, "linhas_processadas": n_rows - n_hit,
+        "negocios_novos": len(b.difference(a)), "negocios_removidos": len(a.difference(b)),
+    }
+    with stage("delta_transicoes", len(df)):
+        delta["transicoes"] = phase_transitions(prev_df, df, key)
+    with stage("delta_cubo", len(df)):
+        cubo = update_base_cube(prev["cubo"], prev_df, df)
+    return {"df": df, "cubo": cubo, "delta": delta}
+
+# ========================= Snapshot colunar (Feather) =========================
+# A base limpa é gravada em Arrow/Feather sem compressão, chaveada pelo hash do CSV,
+# e relida com memory_map. Mudou a limpeza? Suba SNAPSHOT_VERSION para invalidar.
+# Ao lado ficam o cubo base (.cubo) e, quando houve export anterior, as transições (.delta).
+# Buckets/canais dependem da taxonomia: o id dela entra no nome (taxonomia nova = base nova).
+SNAPSHOT_VERSION = 5
+SNAPSHOT_MAX_AGE_S = 7 * 24 * 60 * 60
+# Falhas esperadas ao ler um snapshot (apagado pelo prune, gravação interrompida, versão antiga):
+# o CSV é lido por inteiro sem aviso. Qualquer outra é bug do caminho incremental e vira aviso.
+SNAPSHOT_ERRORS = (OSError, ValueError, KeyError, pa.ArrowException)
+log = logging.getLogger(__name__)
+
+def snapshot_path(snap_dir, file_hash) -> Path:
+    return Path(snap_dir) / f"crm_{file_hash[:32]}_{TAXONOMIA['id']}_v{SNAPSHOT_VERSION}.feather"
+
+def _sidecar(path, kind) -> Path:
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{kind}.feather")
+
+def _write_feather(df, path, meta):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    meta = {**(table.schema.metadata or {}), b"crm_meta": json.dumps(meta).encode()}
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    feather.write_feather(table.replace_schema_metadata(meta), tmp, compression="uncompressed")
+    os.replace(tmp, path)
+
+def _read_feather(path):
+    table = feather.read_table(path, memory_map=True)
+    return table.to_pandas(types_mapper=arrow_string_dtype), json.loads((table.schema.metadata or {}).get(b"crm_meta", b"{}"))
+
+def save_snapshot(ds, path, latest=True):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # sidecars primeiro: o .feather principal só aparece com o conjunto completo
+    _write_feather(ds["cubo"].rename("n").reset_index(), _sidecar(path, "cubo"), {})
+    if ds["delta"] is not None:
+        info = {k: v for k, v in ds["delta"].items() if k != "transicoes"}
+        _write_feather(ds["delta"]["transicoes"], _sidecar(path, "delta"), info)
+    _write_feather(ds["df"], path, ds["df"].attrs)
+    if latest:
+        (path.parent / f"ultimo_{TAXONOMIA['id']}_v{SNAPSHOT_VERSION}.txt").write_text(path.name)
+    prune_snapshots(path.parent)
+
+def load_snapshot(path) -> dict:
+    df, df.attrs = _read_feather(path)
+    cubo, _ = _read_feather(_sidecar(path, "cubo"))
+    ds = {"df": df, "cubo": cubo.set_index(CUBE_LEVELS)["n"], "delta": None}
+    if _sidecar(path, "delta").exists():
+        trans, info = _read_feather(_sidecar(path, "delta"))
+        ds["delta"] = {**info, "transicoes": trans}
+    return ds
+
+def latest_snapshot(snap_dir):
+    """Snapshot do último CSV ingerido nesta pasta (base para a ingestão incremental)."""
+    try:
+        path = Path(snap_dir) / (Path(snap_dir) / f"ultimo_{TAXONOMIA['id']}_v{SNAPSHOT_VERSION}.txt").read_text().strip()
+    except OSError:
+        return None
+    return path if path.exists() else None
+
+def prune_snapshots(snap_dir, max_age_s=SNAPSHOT_MAX_AGE_S):
+    """Apaga snapshots antigos (por idade, para não remover os de um lote em andamento)."""
+    limite = time.time() - max_age_s
+    for snap in Path(snap_dir).glob("crm_*.feather"):
+        try:
+            if snap.stat().st_mtime < limite:
+                snap.unlink()
+        except FileNotFoundError:
+            pass
+
+def _aviso_incremental(etapa, e) -> str:
+    """Registra a falha inesperada de `etapa` (log com traceback + Trace ativo) e devolve o aviso."""
+    log.warning("%s falhou; CSV lido por inteiro", etapa, exc_info=e)
+    aviso = f"{etapa} falhou ({type(e).__name__}: {e}); o CSV foi lido por inteiro."
+    tr = _trace.get()
+    if tr is not None:
+        tr.meta["aviso_incremental"] = aviso
+    return aviso
+
+def load_crm_dataset(src, file_hash=None, snap_dir=None, key=DEAL_KEY, block_size=CHUNK_BYTES, delta=True) -> dict:
+    """Base limpa + cubo base (+ delta vs. o export anterior), lendo `src` (bytes ou arquivo binário) em blocos.
+
+    Com `snap_dir`, reaproveita o snapshot do mesmo conteúdo ou parte do último ingerido.
+    `delta=False` para ingestões concorrentes na mesma pasta: sem "último" bem definido, não
+    compara nem passa a ser o último (o snapshot do conteúdo é gravado do mesmo jeito).
+    Falha inesperada no caminho incremental não derruba a carga, mas fica em
+    `df.attrs["aviso_incremental"]` (e no log/Trace)."""
+    f = BytesIO(src) if isinstance(src, (bytes, bytearray)) else src
+    file_hash = file_hash or file_sha256(f)
+    path = snapshot_path(snap_dir, file_hash) if snap_dir else None
+    aviso = erro = None
+    if path is not None and path.exists():
+        try:
+            with stage("snapshot_leitura"):
+                return load_snapshot(path)
+        except SNAPSHOT_ERRORS:
+            pass  # snapshot corrompido/incompatível: refaz a partir do CSV
+        except Exception as e:
+            aviso = _aviso_incremental("Leitura do snapshot", e)
+    ds = None
+    prev_path = latest_snapshot(snap_dir) if snap_dir and delta else None
+    if prev_path is not None and prev_path != path:
+        prev = None
+        try:
+            prev = load_snapshot(prev_path)
+        except SNAPSHOT_ERRORS:
+            pass  # export anterior sumiu/corrompido: sem delta
+        except Exception as e:
+            aviso = _aviso_incremental("Leitura do export anterior", e)
+        if prev is not None:
+            try:
+                ds = stream_crm(f, lambda chunks, skipped: delta_crm_chunks(chunks, skipped, prev, key), block_size)
+            except KeyError:
+                pass  # colunas da chave ausentes num dos exports: sem delta
+            except Exception as e:
+                erro = e
+    if ds is None:
+        ds = ingest_stream(f, block_size)  # CSV ruim de fato: o erro sai daqui
+        if erro is not None:  # o CSV lê por inteiro, então a falha era do delta
+            aviso = _aviso_incremental("Ingestão incremental", erro)
+    with stage("ordenacao", len(ds["df"])):
+        ds["df"] = sort_by_criado(ds["df"])
+    ds["df"].attrs["file_hash"] = file_hash
+    if path is not None:
+        with stage("snapshot_gravacao", len(ds["df"])):
+            save_snapshot(ds, path, latest=delta)
+    if aviso:  # depois de gravar: vale para esta carga, não para quem reler o snapshot
+        ds["df"].attrs["aviso_incremental"] = aviso
+    return ds
+
+# ========================= Vários arquivos =========================
+# Um export por funil/mês: cada CSV é lido com sua própria detecção de encoding/separador,
+# em paralelo (threads: o Arrow solta o GIL na leitura), e as bases viram uma só com a coluna
+# "Arquivo" para filtrar. Um negócio (DEAL_KEY) presente em mais de um arquivo fica só com as
+# linhas do último arquivo da lista; duplicatas dentro de um mesmo arquivo continuam como estão.
+LOAD_WORKERS = min(8, os.cpu_count() or 1)
+
+def combined_hash(file_hashes) -> str:
+    """Chave do conjunto de arquivos (a ordem importa: define quem prevalece nas duplicatas)."""
+    return hashlib.sha256("|".join(file_hashes).encode()).hexdigest()
+
+def file_labels(names) -> list:
+    """Rótulo por arquivo (nome sem extensão), com sufixo quando dois arquivos têm o mesmo nome."""
+    out = []
+    for name in names:
+        base = label = Path(name).stem
+        n = 2
+        while label in out:
+            label, n = f"{base} ({n})", n + 1
+        out.append(label)
+    return out
+
+def merge_datasets(dss, labels, key=DEAL_KEY) -> dict:
+    frames = []
+    for i, ds in enumerate(dss):
+        d = ds["df"]
+        frames.append(d.assign(Arquivo=pd.Categorical.from_codes(np.full(len(d), i, dtype=np.int16), categories=labels)))
+    df = concat_clean(frames)
+    src = df["Arquivo"].cat.codes.to_numpy()
+    deal = pd.util.hash_pandas_object(df[key], index=False).to_numpy()
+    keep = src == pd.Series(src).groupby(deal).transform("max").to_numpy()
+    removidas = int(len(df) - keep.sum())
+    if removidas:
+        df = df.take(np.flatnonzero(keep)).reset_index(drop=True)
+        cubo = build_base_cube(df)
+    else:
+        cubo = merge_cubes([ds["cubo"] for ds in dss])
+    df.attrs = {"linhas_ignoradas": sum(ds["df"].attrs.get("linhas_ignoradas", 0) for ds in dss),
+                "formato_data": list(dict.fromkeys(f for ds in dss for f in ds["df"].attrs.get("formato_data") or [])),
+                "arquivos": list(labels), "duplicadas_removidas": removidas}
+    avisos = [ds["df"].attrs["aviso_incremental"] for ds in dss if ds["df"].attrs.get("aviso_incremental")]
+    if avisos:
+        df.attrs["aviso_incremental"] = " ".join(avisos)
+    return {"df": sort_by_criado(df), "cubo": cubo, "delta": None}
+
+def load_crm_datasets(srcs, labels, file_hashes=None, snap_dir=None, key=DEAL_KEY) -> dict:
+    """Um dataset por arquivo, lidos em paralelo e juntados (com um arquivo só, o próprio)."""
+    file_hashes = file_hashes or [None] * len(srcs)
+    if len(srcs) == 1:
+        return load_crm_dataset(srcs[0], file_hashes[0], snap_dir, key)
+
+    def load(src, file_hash, label):
+        try:
+            # em paralelo não há "export anterior": cada arquivo é lido inteiro
+            return load_crm_dataset(src, file_hash, snap_dir, key, delta=False)
+        except KeyError as e:
+            raise KeyError(f"{label}: {e.args[0]}") from e
+
+    with ThreadPoolExecutor(min(LOAD_WORKERS, len(srcs))) as pool:
+        # cada thread leva o contexto atual: as etapas continuam no Trace do rerun
+        futs = [pool.submit(contextvars.copy_context().run, load, *args) for args in zip(srcs, file_hashes, labels)]
+        dss = [f.result() for f in futs]
+    with stage("juntar_arquivos", sum(len(ds["df"]) for ds in dss)):
+        return merge_datasets(dss, labels, key)
+
+# ========================= Motor do funil (uma passada por tabela) =========================
+def funnel_counts(d, by):
+    """Contagem de leads por `by` (coluna ou lista) x fase (bucket) num único groupby."""
+    keys = [by] if isinstance(by, str) else list(by)
+    counts = d.groupby(keys + ["_bucket"], observed=True).size()
+    counts = counts.unstack("_bucket") if len(counts) else pd.DataFrame(index=counts.index.droplevel(-1))
+    counts = counts.reindex(columns=fases_cols).fillna(0).astype("int64")
+    counts.columns = list(fases_cols)
+    return counts
+
+def funnel_totals(d):
+    return d["_bucket"].value_counts().reindex(fases_cols, fill_value=0)
+
+def conv_metrics(leads, reun, vend):
+    return pd.DataFrame({
+        "% Reuniões/Leads": [pct(a, b) for a, b in zip(reun, leads)],
+        "% Vendas/Leads": [pct(a, b) for a, b in zip(vend, leads)],
+        "% Vendas/Reuniões": [pct(a, b) for a, b in zip(vend, reun)],
+    })
+
+def reunioes(counts):
+    return counts["Agendando Reunião"] + counts["Reuniões Agendadas"]
+
+def build_funil_df(d):
+    c = funnel_counts(d, "Canal de Origem").reindex(canal_ordem, fill_value=0)
+    out = c.rename_axis("Canal de Origem").reset_index()
+    out.insert(1, "Leads Recebidos", c.sum(axis=1).to_numpy())
+    total_row = {"Canal de Origem": "TOTAL"}
+    for col in out.columns[1:]:
+        total_row[col] = out[col].sum()
+    return pd.concat([out, pd.DataFrame([total_row])], ignore_index=True)
+
+def build_conv_df(funil):
+    leads = funil["Leads Recebidos"].tolist()
+    out = conv_metrics(leads, reunioes(funil).tolist(), funil["Negócio Fechado"].tolist())
+    out.insert(0, "Canal de Origem", funil["Canal de Origem"].to_numpy())
+    return out
+
+def build_prospec_resumo_df(d):
+    c = funnel_counts(d, "Responsável")
+    tot = funnel_totals(d)
+    leads = c.sum(axis=1).tolist() + [len(d)]
+    reun = reunioes(c).tolist() + [int(reunioes(tot))]
+    vend = c["Negócio Fechado"].tolist() + [int(tot["Negócio Fechado"])]
+    out = pd.DataFrame({
+        "Vendedora": c.index.tolist() + ["TOTAL"],
+        "Leads Gerados": leads, "Reuniões Agendadas": reun, "Vendas": vend,
+    })
+    conv = conv_metrics(leads, reun, vend)
+    out["Conversão Reunião (%)"] = conv["% Reuniões/Leads"]
+    out["Conversão Venda (%)"] = conv["% Vendas/Leads"]
+    return out
+
+def build_prospec_funil_df(d):
+    c = funnel_counts(d, "Responsável")
+    if c.empty:
+        return pd.DataFrame()
+    out = c.rename_axis("Vendedora").reset_index()
+    out.insert(1, "Leads Gerados (base filtrada)", c.sum(axis=1).to_numpy())
+    tot = {"Vendedora": "TOTAL"}
+    for col in out.columns[1:]:
+        tot[col] = out[col].sum()
+    return pd.concat([out, pd.DataFrame([tot])], ignore_index=True)
+
+def build_vend_origem_df(d):
+    resps = sorted(d["Responsável"].dropna().unique())
+    if not resps:
+        return pd.DataFrame()
+    origem = d["Canal de Origem"].map({canal_prospeccao: canal_prospeccao, **{c: "Leads de Mkt" for c in mkt_canais}})
+    idx = pd.MultiIndex.from_product([resps, [canal_prospeccao, "Leads de Mkt"]])
+    c = funnel_counts(d.assign(_origem=origem), ["Responsável", "_origem"]).reindex(idx, fill_value=0)
+    leads = c.sum(axis=1).tolist(); reun = reunioes(c).tolist(); vend = c["Negócio Fechado"].tolist()
+    out = pd.DataFrame({
+        "Vendedora": idx.get_level_values(0), "Origem do Lead": idx.get_level_values(1),
+        "Leads Trabalhados": leads, "Reuniões Agendadas": reun, "Vendas": vend,
+    })
+    conv = conv_metrics(leads, reun, vend)
+    out["Conversão Reunião (%)"] = conv["% Reuniões/Leads"]
+    out["Conversão Venda (%)"] = conv["% Vendas/Leads"]
+    return out
+
+def build_daily_cube(d) -> pd.Series:
+    """Leads por Dia x Responsável x Canal x fase — base dos gráficos diários."""
+    base = d[d["Criado"].notna()]
+    dia = base["Criado"].dt.floor("D").rename("Dia")
+    return base.groupby([dia, "Responsável", "Canal de Origem", "_bucket"], observed=True, dropna=False).size()
+
+# ===== Séries e frames dos gráficos (agregados no servidor, tamanho limitado) =====
+# O navegador recebe só o que desenha: uma linha por barra, já somada/normalizada, e as
+# séries longas viram semanas ou meses para o payload não crescer com o período.
+CHART_DAILY_MAX_DAYS = 92   # acima disso as barras viram semanas (ou meses)
+CHART_MAX_POINTS = 3000     # teto de períodos x categorias enviados ao navegador
+CHART_FREQS = {"D": 1, "W-MON": 7, "MS": 31}
+
+def chart_freq(cube, all_days, by=None) -> str:
+    """Dia até CHART_DAILY_MAX_DAYS; depois semana ou mês, o primeiro que couber em CHART_MAX_POINTS."""
+    n_cats = 1 if by is None or cube.empty else max(cube.index.get_level_values(by).nunique(), 1)
+    for freq, dias in CHART_FREQS.items():
+        if freq == "D" and len(all_days) > CHART_DAILY_MAX_DAYS:
+            continue
+        if -(-len(all_days) // dias) * n_cats <= CHART_MAX_POINTS:
+            return freq
+    return "MS"
+
+def daily_series(cube, all_days, by=None, mm_window=None, freq="D") -> pd.DataFrame:
+    """Fatia o cubo por `by` (ou total), zera dias sem lead e calcula a média móvel de todas as séries de uma vez.
+
+    Com `freq` semanal/mensal os dias são somados por período (rótulo = início); a média móvel
+    continua em dias e é somada junto, então fica na mesma escala das barras."""
+    if by is None:
+        wide = cube.groupby(level="Dia").sum().to_frame("Leads")
+    else:
+        wide = cube.groupby(level=["Dia", by], observed=True).sum().unstack(by, fill_value=0)
+        wide = wide[sorted(wide.columns)]
+    wide = wide.reindex(all_days, fill_value=0)
+    mm = wide.rolling(mm_window, min_periods=1).mean() if mm_window else None
+    if freq != "D":
+        wide = wide.resample(freq, label="left", closed="left").sum()
+        mm = mm.resample(freq, label="left", closed="left").sum() if mm is not None else None
+    if by is None:
+        g = wide.reset_index()
+        if mm is not None:
+            g["MM"] = mm["Leads"].to_numpy()
+        return g
+    # melt percorre coluna a coluna: sai ordenado por categoria e depois por dia
+    g = wide.reset_index().melt(id_vars="Dia", var_name=by, value_name="Leads")
+    if mm is not None:
+        g["MM"] = mm.to_numpy().ravel(order="F")
+    return g
+
+def build_chart_frames(funil_df, conv_df, prospec_resumo_df, prospec_funil_df):
+    """Tabelas em formato longo para os gráficos Altair, já agregadas (o gráfico só desenha)."""
+    return {**funnel_chart_frames(funil_df, conv_df), **seller_chart_frames(prospec_resumo_df, prospec_funil_df)}
+
+def funnel_chart_frames(funil_df, conv_df):
+    frames = {}
+    melt = funil_df[funil_df["Canal de Origem"]!="TOTAL"].melt(
+        id_vars=["Canal de Origem"], value_vars=fases_cols, var_name="Fase", value_name="Qtd")
+    melt["fase_ord"] = melt["Fase"].map(phase_rank).astype("int64")
+    # proporção de cada fase no canal (antes: stack="normalize" no navegador)
+    tot = melt.groupby("Canal de Origem", sort=False)["Qtd"].transform("sum")
+    melt["Proporção"] = (melt["Qtd"] / tot.where(tot > 0)).fillna(0.0)
+    frames["melt"] = melt
+    frames["conv_melt"] = conv_df[conv_df["Canal de Origem"]!="TOTAL"].melt(
+        id_vars=["Canal de Origem"], var_name="Métrica", value_name="Valor")
+    return frames
+
+def seller_chart_frames(prospec_resumo_df, prospec_funil_df):
+    frames = {}
+    # antes: transform_fold no navegador
+    frames["vend_melt"] = prospec_resumo_df[prospec_resumo_df["Vendedora"]!="TOTAL"].melt(
+        id_vars=["Vendedora"], value_vars=["Leads Gerados","Reuniões Agendadas","Vendas"],
+        var_name="Métrica", value_name="Valor")
+    if not prospec_funil_df.empty:
+        pf = prospec_funil_df[prospec_funil_df["Vendedora"]!="TOTAL"].copy()
+        for c in phase_order:
+            if c not in pf.columns: pf[c]=0
+        melted_v = pf.melt(id_vars=["Vendedora"], value_vars=phase_order, var_name="Fase", value_name="Qtd")
+        melted_v["fase_ord"] = melted_v["Fase"].map(phase_rank).astype("int64")
+        frames["melted_v"] = melted_v[melted_v["Qtd"] > 0]  # barra de tamanho zero não desenha nada
+    return frames
+
+# ===== Coortes de criação =====
+# Coorte = semana (início na segunda) ou mês do Criado. A conversão é "até a data do export":
+# um negócio conta em cada marco que a fase atual já alcançou (um Fechado também teve reunião);
+# fases de perda não contam em nenhum. Tudo sai do cubo diário do filtro (dias x vendedora x
+# canal x fase, já em cache), não das linhas: anos de base com dezenas de vendedoras são
+# alguns milhares de células somadas num groupby.
+COHORT_FREQS = {"Semanal": "W-MON", "Mensal": "MS"}
+COHORT_MARCOS = {
+    "Reunião": ["Agendando Reunião", "Reuniões Agendadas", "Proposta e Negociação", "Finalizando Venda", "Negócio Fechado"],
+    "Proposta": ["Proposta e Negociação", "Finalizando Venda", "Negócio Fechado"],
+    "Finalizando Venda": ["Finalizando Venda", "Negócio Fechado"],
+    "Negócio Fechado": ["Negócio Fechado"],
+}
+
+def cohort_start(dias, freq) -> np.ndarray:
+    """Início da semana (segunda) ou do mês de cada dia (datetime64[ns])."""
+    d = np.asarray(dias, dtype="datetime64[D]")
+    if freq == "MS":
+        return d.astype("datetime64[M]").astype("datetime64[ns]")
+    return (d - (d.view("int64") + 3) % 7).astype("datetime64[ns]")  # 01/01/1970 foi quinta
+
+def cohort_table(cube, freq="MS", by=None, ref=None) -> pd.DataFrame:
+    """Coortes x `by` (ou total): leads, quantos chegaram a cada marco e % dos leads da coorte.
+
+    `ref` é a data de referência (do export) para a idade da coorte em dias."""
+    cube = cube[cube.index.get_level_values("Dia").notna()]
+    keys = [pd.Index(cohort_start(cube.index.get_level_values("Dia"), freq), name="Coorte")]
+    if by is not None:
+        keys.append(cube.index.get_level_values(by))
+    n = cube.to_numpy()
+    b = cube.index.get_level_values("_bucket")
+    vals = {"Leads": n, **{m: np.where(b.isin(fases), n, 0) for m, fases in COHORT_MARCOS.items()}}
+    out = pd.DataFrame(vals).groupby(keys, observed=True, sort=True).sum()
+    for m in COHORT_MARCOS:
+        out[f"% {m}"] = (out[m] / out["Leads"] * 100).round(2)
+    out = out.reset_index()
+    if ref is not None:
+        out.insert(1, "Idade (dias)", (pd.Timestamp(ref) - out["Coorte"]).dt.days)
+    return out
+
+# ===== Filtro: base ordenada por Criado + tabela por código de categoria =====
+# A base é ordenada por Criado uma vez por upload (estável, NaT no fim): o período vira uma
+# fatia por busca binária, sem converter cada timestamp em `date` a cada rerun. Vendedora e
+# canal viram uma tabela booleana indexada pelo código da categoria (um gather, sem isin).
+def sort_by_criado(df) -> pd.DataFrame:
+    out = df.take(np.argsort(df["Criado"].to_numpy(), kind="stable")).reset_index(drop=True)
+    out.attrs = {**df.attrs, "ordem": "Criado"}
+    return out
+
+def date_slice(df, d_ini, d_fim):
+    """Posições [lo, hi) das linhas com Criado em [d_ini, d_fim] (base ordenada por Criado)."""
+    c = df["Criado"].to_numpy()
+    ini, fim = pd.Timestamp(d_ini), pd.Timestamp(d_fim) + pd.Timedelta(days=1)
+    lo, hi = np.searchsorted(c, np.array([ini, fim], dtype=c.dtype))  # NaT fica depois de tudo
+    return int(lo), int(hi)
+
+def category_mask(s, selected) -> np.ndarray:
+    """Linhas de `s` com valor em `selected`; em categóricas, via tabela por código."""
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return s.isin(selected).to_numpy()
+    lut = np.zeros(len(s.cat.categories) + 1, dtype=bool)  # última posição = código -1 (NaN)
+    idx = s.cat.categories.get_indexer(list(selected))
+    lut[idx[idx >= 0]] = True
+    return lut[s.cat.codes.to_numpy()]
+
+def filter_rows(df, d_ini, d_fim, sel_vendedoras, sel_canais, com_datas=True, sel_arquivos=None) -> pd.DataFrame:
+    """Linhas do estado de filtros, na ordem da base; sem filtro efetivo, a própria base."""
+    mask = None
+    if com_datas and df.attrs.get("ordem") == "Criado":
+        lo, hi = date_slice(df, d_ini, d_fim)
+        if (lo, hi) != (0, len(df)):
+            df = df.iloc[lo:hi]
+    elif com_datas:
+        c = df["Criado"]
+        mask = ((c >= pd.Timestamp(d_ini)) & (c < pd.Timestamp(d_fim) + pd.Timedelta(days=1))).to_numpy()
+    for col, sel in (("Responsável", sel_vendedoras), ("Canal de Origem", sel_canais), ("Arquivo", sel_arquivos)):
+        if sel:
+            m = category_mask(df[col], sel)
+            mask = m if mask is None else mask & m
+    if mask is None or mask.all():
+        return df
+    return df.take(np.flatnonzero(mask))
+
+def report_base(df, d_ini, d_fim, sel_vendedoras, sel_canais, only_prospec, sel_arquivos=None) -> dict:
+    """Parte barata do relatório: base filtrada e totais por fase (os cards da Visão Geral)."""
+    com_datas = bool(df["Criado"].notna().any())
+    with stage("filtro", len(df)) as m:
+        df = filter_rows(df, d_ini, d_fim, sel_vendedoras, sel_canais, com_datas, sel_arquivos)
+        base_vendedora_df = df if not only_prospec else df[df["Canal de Origem"] == canal_prospeccao]
+        m["linhas"] = len(df)
+    with stage("totais_fase", len(df)):
+        fases_tot = funnel_totals(df)
+    return {"df": df, "base_vendedora_df": base_vendedora_df, "fases_tot": fases_tot,
+            "filtro": {"d_ini": d_ini, "d_fim": d_fim, "sel_vendedoras": sel_vendedoras, "sel_canais": sel_canais,
+                       "sel_arquivos": sel_arquivos, "com_datas": com_datas}}
+
+def _part_funil(base, base_cube):
+    df = base["df"]
+    out = {}
+    with stage("tabela_funil", len(df)):
+        out["funil_df"] = build_funil_df(df)
+    with stage("tabela_conversao", len(df)):
+        out["conv_df"] = build_conv_df(out["funil_df"])
+    with stage("frames_graficos"):
+        out.update(funnel_chart_frames(out["funil_df"], out["conv_df"]))
+    return out
+
+def _part_vendedoras(base, base_cube):
+    df, bv = base["df"], base["base_vendedora_df"]
+    out = {}
+    with stage("tabela_vendedora_resumo", len(bv)):
+        out["prospec_resumo_df"] = build_prospec_resumo_df(bv)
+    with stage("tabela_vendedora_funil", len(bv)):
+        out["prospec_funil_df"] = build_prospec_funil_df(bv)
+    with stage("tabela_vendedora_origem", len(df)):
+        out["vend_origem_df"] = build_vend_origem_df(df)
+    with stage("frames_graficos"):
+        out.update(seller_chart_frames(out["prospec_resumo_df"], out["prospec_funil_df"]))
+    return out
+
+def _part_cubo(base, base_cube):
+    f = base["filtro"]
+    with stage("cubo_diario", len(base["df"])):
+        # o cubo base não tem a coluna Arquivo: com filtro de arquivos ele é refeito da base filtrada
+        if base_cube is None or f["sel_arquivos"]:
+            return {"daily_cube": build_daily_cube(base["df"])}
+        return {"daily_cube": filter_cube(base_cube, f["d_ini"], f["d_fim"], f["sel_vendedoras"], f["sel_canais"],
+                                          f["com_datas"])}
+
+# Partes pesadas, independentes entre si: o app calcula cada uma em segundo plano (ReportJobs)
+REPORT_PARTS = {"funil": _part_funil, "vendedoras": _part_vendedoras, "cubo": _part_cubo}
+
+def report_part(nome, base, base_cube=None) -> dict:
+    return REPORT_PARTS[nome](base, base_cube)
+
+def build_report(df, d_ini, d_fim, sel_vendedoras, sel_canais, only_prospec, base_cube=None, sel_arquivos=None):
+    """Filtra a base e monta todas as tabelas/séries derivadas de um estado de filtros.
+
+    Com `base_cube`, o cubo diário sai de um recorte dele em vez de um groupby na base filtrada."""
+    rel = report_base(df, d_ini, d_fim, sel_vendedoras, sel_canais, only_prospec, sel_arquivos)
+    for nome in REPORT_PARTS:
+        rel.update(report_part(nome, rel, base_cube))
+    return rel
+
+# ===== Memo por estado de filtros =====
+def _np_block(a, s):
+    root = a
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    size = int(s.memory_usage(deep=True, index=False)) if a.dtype == object else root.nbytes
+    return [(root.__array_interface__["data"][0], size)]
+
+def _mem_blocks(s):
+    """(endereço, bytes) da memória de uma Series; uma vista (iloc) devolve os blocos da original."""
+    arr = s.array
+    if hasattr(arr, "_pa_array"):  # Arrow: fatias apontam para os mesmos buffers
+        return [(b.address, b.size) for c in arr._pa_array.chunks for b in c.buffers() if b is not None]
+    if isinstance(arr, pd.Categorical):
+        cats = arr.categories
+        return _np_block(arr.codes, s) + [(id(cats), int(cats.memory_usage(deep=True)))]
+    if hasattr(arr, "_mask"):  # Int64/boolean do pandas
+        return _np_block(arr._data, s) + _np_block(arr._mask, s)
+    return _np_block(np.asarray(arr), s)
+
+def estimate_nbytes(obj, seen=None):
+    """Bytes estimados de `obj`, contando cada buffer uma vez.
+
+    Blocos já em `seen` (p.ex. da base guardada em outro lugar, da qual `obj` é uma vista)
+    não contam de novo; os contados entram em `seen`."""
+    seen = set() if seen is None else seen
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_nbytes(v, seen) for v in obj)
+    if isinstance(obj, pd.DataFrame):
+        blocks = [b for _, col in obj.items() for b in _mem_blocks(col)]
+    elif isinstance(obj, pd.Series):
+        blocks = _mem_blocks(obj)
+    else:
+        return sys.getsizeof(obj)
+    blocks.append((id(obj.index), int(obj.index.memory_usage(deep=True))))
+    n = 0
+    for addr, size in blocks:
+        if addr not in seen:
+            seen.add(addr)
+            n += size
+    return n
+
+class LRUCache:
+    """Cache LRU por processo, limitado por nº de entradas e por bytes estimados.
+
+    `shared` devolve o que já está guardado em outro lugar (as bases do DatasetStore): a base
+    filtrada sem filtro ou por período é uma vista delas e não conta contra o limite.
+    Os valores são devolvidos sem cópia: quem lê não deve alterá-los.
+    """
+
+    def __init__(self, max_bytes, max_entries=64, shared=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.shared = shared
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        value = compute()
+        seen = set()
+        if self.shared is not None:
+            estimate_nbytes(self.shared(), seen)
+        size = estimate_nbytes(value, seen)
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = value
+                self._sizes[key] = size
+                self._total += size
+            # remove os mais antigos, mas nunca a entrada recém-calculada
+            while len(self._data) > 1 and (self._total > self.max_bytes or len(self._data) > self.max_entries):
+                old_key, _ = self._data.popitem(last=False)
+                self._total -= self._sizes.pop(old_key)
+        return value
+
+# ===== Bases compartilhadas entre sessões =====
+class DatasetStore:
+    """Bases limpas (df + cubo) por hash do CSV, uma cópia por processo para todas as sessões.
+
+    Cada sessão mantém um "lease" na base que está vendo (renovado a cada rerun); uma base
+    sem sessões sai após `ttl` s ociosa, e sessões que somem sem avisar expiram após
+    `lease_ttl` s sem rerun. Uploads simultâneos do mesmo arquivo carregam uma vez só.
+    Acima de `max_bytes` saem as bases ociosas (as mais antigas antes) e, se não bastar, as das
+    sessões há mais tempo sem rerun (que recarregam no próximo clique, do snapshot se houver).
+    Os valores são devolvidos sem cópia: quem lê não deve alterá-los.
+    """
+
+    def __init__(self, ttl=15 * 60, lease_ttl=60 * 60, max_bytes=DATASET_MAX_BYTES):
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+        self.max_bytes = max_bytes
+        self._data = {}
+        self._sizes = {}
+        self._leases = {}      # sessão -> (hash, último rerun)
+        self._idle_since = {}  # hash -> quando ficou sem sessões
+        self._loading = {}     # hash -> lock da carga em andamento
+        self._lock = threading.Lock()
+
+    def acquire(self, key, session, load):
+        now = time.monotonic()
+        with self._lock:
+            self._leases[session] = (key, now)
+            self._sweep(now)
+            if key in self._data:
+                return self._data[key]
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        with load_lock:
+            with self._lock:
+                if key in self._data:
+                    return self._data[key]
+            try:
+                value = load()
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(key, None)
+                raise
+            size = estimate_nbytes(value)
+            with self._lock:
+                # a base entra antes de o lock de carga sair: quem chega agora já a encontra
+                self._data[key] = value
+                self._sizes[key] = size
+                self._idle_since.pop(key, None)
+                self._loading.pop(key, None)
+                self._evict(keep=key)
+        return value
+
+    def datasets(self) -> list:
+        with self._lock:
+            return list(self._data.values())
+
+    def release(self, session):
+        with self._lock:
+            self._leases.pop(session, None)
+            self._sweep(time.monotonic())
+
+    def _sweep(self, now):
+        for s, (_, seen) in list(self._leases.items()):
+            if now - seen > self.lease_ttl:
+                del self._leases[s]
+        in_use = {k for k, _ in self._leases.values()}
+        for k in list(self._data):
+            if k in in_use:
+                self._idle_since.pop(k, None)
+            elif now - self._idle_since.setdefault(k, now) > self.ttl:
+                self._remove(k)
+
+    def _evict(self, keep):
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        last = {}
+        for k, seen in self._leases.values():
+            last[k] = max(last.get(k, 0), seen)
+        # ociosas primeiro (por tempo ociosa), depois as em uso (pelo rerun mais recente de cada uma)
+        for k in sorted((k for k in self._data if k != keep),
+                        key=lambda k: (k in last, last.get(k, self._idle_since.get(k, 0)))):
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes[k]
+            self._remove(k)
+
+    def _remove(self, k):
+        del self._data[k]
+        self._sizes.pop(k, None)
+        self._idle_since.pop(k, None)
+
+    def stats(self) -> pd.DataFrame:
+        with self._lock:
+            refs = {}
+            for k, _ in self._leases.values():
+                refs[k] = refs.get(k, 0) + 1
+            rows = [{"arquivo": k[:12], "sessoes": refs.get(k, 0), "linhas": len(ds["df"]),
+                     "mb": round(self._sizes.get(k, 0) / 2**20, 1)} for k, ds in self._data.items()]
+        return pd.DataFrame(rows, columns=["arquivo", "sessoes", "linhas", "mb"])
+
+# ===== Cálculo em segundo plano =====
+# As partes pesadas do relatório (e as exportações) rodam num pool de threads do processo,
+# uma vez por (filtros, parte): o app desenha os cards logo e cada seção quando a sua parte
+# chega. Jobs iguais de sessões diferentes são compartilhados; quando uma sessão muda os
+# filtros, o que só ela esperava é cancelado (na fila, sai; em andamento, para na próxima etapa).
+REPORT_WORKERS = int(os.environ.get("CRM_REPORT_WORKERS", min(4, os.cpu_count() or 1)))
+REPORT_POLL_S = 0.2  # intervalo entre `tick`s enquanto espera as partes
+
+class ReportJobs:
+    """Pool de jobs por (chave de filtros, parte), com resultados guardados em `cache` (LRUCache).
+
+    Como no DatasetStore, uma sessão que some sem avisar deixa de contar após `lease_ttl` s sem pedir nada."""
+
+    def __init__(self, cache, workers=REPORT_WORKERS, lease_ttl=60 * 60):
+        self.cache = cache
+        self.lease_ttl = lease_ttl
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="crm-relatorio")
+        self._jobs = {}     # (chave, parte) -> (future, evento de cancelamento)
+        self._waiting = {}  # sessão -> {(chave, parte)} que ela espera
+        self._seen = {}     # sessão -> último pedido
+        self._lock = threading.RLock()  # o callback de um job já pronto roda dentro de submit
+
+    def submit(self, session, key, parts) -> dict:
+        """{parte: Future} para `parts` ({parte: função sem argumentos}); cancela os jobs de outras
+        chaves que só esta sessão esperava. Partes já em cache voltam como futures prontos."""
+        futs = {}
+        ctx = contextvars.copy_context()  # etapas dos jobs entram no Trace de quem pediu
+        with self._lock:
+            now = time.monotonic()
+            self._sweep(now)
+            self._seen[session] = now
+            self._drop(session, keep=key)
+            waiting = self._waiting.setdefault(session, set())
+            for nome, fn in parts.items():
+                jk = (key, nome)
+                hit = self.cache.get(jk)
+                if hit is not None:
+                    futs[nome] = Future()
+                    futs[nome].set_result(hit)
+                    continue
+                if jk in self._jobs:
+                    futs[nome] = self._jobs[jk][0]
+                    waiting.add(jk)
+                    continue
+                ev = threading.Event()
+                fut = self._pool.submit(ctx.copy().run, self._run, jk, fn, ev)
+                self._jobs[jk] = (fut, ev)
+                futs[nome] = fut
+                waiting.add(jk)
+                # por último: se o job já terminou, o callback roda aqui mesmo e limpa _jobs/_waiting
+                fut.add_done_callback(lambda f, jk=jk: self._done(jk, f))
+        return futs
+
+    def results(self, session, key, parts, tick=None, poll=REPORT_POLL_S):
+        """(parte, resultado) na ordem em que ficam prontos. Parte cancelada (p.ex. a sessão expirou
+        no meio do cálculo e outra mudou de filtros) é pedida de novo em vez de virar erro.
+
+        `tick` é chamado a cada `poll` s de espera: no app, uma chamada st.* em que o Streamlit pode
+        interromper o script velho quando há rerun pendente (e o rerun cancela os jobs velhos)."""
+        futs = self.submit(session, key, parts)
+        while futs:
+            names = {f: nome for nome, f in futs.items()}
+            done, _ = wait(names, timeout=poll if tick else None, return_when=FIRST_COMPLETED)
+            if not done:
+                tick()
+                continue
+            for f in done:
+                nome = names[f]
+                del futs[nome]
+                try:
+                    res = f.result()
+                except (CancelledError, JobCancelled):
+                    futs.update(self.submit(session, key, {nome: parts[nome]}))
+                    continue
+                yield nome, res
+
+    def release(self, session):
+        with self._lock:
+            self._forget(session)
+
+    def _run(self, jk, fn, ev):
+        if ev.is_set():
+            raise JobCancelled(jk[1])
+        _cancel.set(ev)
+        return self.cache.get_or_compute(jk, fn)
+
+    def _done(self, jk, fut):
+        with self._lock:
+            if self._jobs.get(jk, (None,))[0] is not fut:
+                return  # job antigo, já cancelado: quem espera agora é outro job da mesma chave
+            del self._jobs[jk]
+            for w in self._waiting.values():
+                w.discard(jk)
+
+    def _drop(self, session, keep=None):
+        stale = {jk for jk in self._waiting.get(session, ()) if jk[0] != keep}
+        if not stale:
+            return
+        self._waiting[session] -= stale
+        still = set().union(*self._waiting.values())
+        for jk in stale - still:
+            job = self._jobs.pop(jk, None)
+            if job:
+                job[1].set()
+                job[0].cancel()
+
+    def _forget(self, session):
+        self._drop(session)
+        self._waiting.pop(session, None)
+        self._seen.pop(session, None)
+
+    def _sweep(self, now):
+        for s, seen in list(self._seen.items()):
+            if now - seen > self.lease_ttl:
+                self._forget(s)
+
+# ========================= Exportações =========================
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+DADOS_COLS = ["Fase","Responsável","Nome do Negócio","Fonte","Criado","Motivo de perda"]
+
+def dados_cols(df) -> list:
+    """Colunas de Dados_Limpos (+ Arquivo quando a base junta vários CSVs)."""
+    return DADOS_COLS + (["Arquivo"] if "Arquivo" in df.columns else [])
+
+def report_sheets(rel):
+    return {
+        "Funil_Comercial": rel["funil_df"],
+        "Conversao_Canal": rel["conv_df"],
+        "Vendedora_Resumo": rel["prospec_resumo_df"],
+        "Vendedora_Funil": rel["prospec_funil_df"],
+        "Vendedora_Origem": rel["vend_origem_df"],
+    }
+
+# ===== Excel rápido: linha a linha em constant_memory =====
+# No modo padrão o pandas monta a planilha inteira em memória (várias vezes o tamanho dos
+# dados). No modo rápido cada linha vai direto para o arquivo temporário do xlsxwriter
+# (constant_memory): tempo linear e memória de um bloco. Nesse modo o pandas não serve nem
+# para as tabelas pequenas (escreve coluna a coluna, e o constant_memory só aceita linhas em
+# ordem), então todas as abas passam pelo mesmo escritor.
+EXCEL_MAX_ROWS = 1_048_576  # limite de linhas por aba (inclui o cabeçalho)
+EXCEL_FAST_MIN_ROWS = 100_000
+EXCEL_CHUNK_ROWS = 50_000
+EXCEL_EPOCH = pd.Timestamp("1899-12-30")
+
+def _excel_cols(frame):
+    """Colunas de um bloco como listas Python para o xlsxwriter (vazio = None, data = serial do Excel)."""
+    cols = []
+    for _, s in frame.items():
+        if pd.api.types.is_datetime64_any_dtype(s):
+            s = (s - EXCEL_EPOCH) / pd.Timedelta(days=1)
+        s = s.astype(object)
+        cols.append(s.where(s.notna(), None).tolist())
+    return cols
+
+def _write_sheet_rows(wb, name, frame, fmts):
+    ws = wb.add_worksheet(name)
+    for j, (col, s) in enumerate(frame.items()):
+        ws.write_string(0, j, str(col), fmts["header"])
+        if pd.api.types.is_datetime64_any_dtype(s):
+            ws.set_column(j, j, None, fmts["datetime"])
+    for start in range(0, len(frame), EXCEL_CHUNK_ROWS):
+        cols = _excel_cols(frame.iloc[start:start + EXCEL_CHUNK_ROWS])
+        for i, row in enumerate(zip(*cols), start + 1):
+            ws.write_row(i, 0, row)
+
+def build_excel(rel, rapido=None, dividir=True) -> bytes:
+    """Excel do relatório. `rapido` (None = automático a partir de EXCEL_FAST_MIN_ROWS linhas) grava
+    linha a linha; `dividir` reparte Dados_Limpos em Dados_Limpos_2, _3... no limite de linhas do Excel."""
+    dados = rel["df"][dados_cols(rel["df"])]
+    if rapido is None:
+        rapido = len(dados) >= EXCEL_FAST_MIN_ROWS
+    por_aba = EXCEL_MAX_ROWS - 1
+    partes = [dados.iloc[i:i + por_aba] for i in range(0, len(dados), por_aba)] if dividir and len(dados) else [dados]
+    abas = {"Dados_Limpos" if k == 0 else f"Dados_Limpos_{k + 1}": parte for k, parte in enumerate(partes)}
+    abas.update(report_sheets(rel))
+    buffer_xlsx = BytesIO()
+    with stage("excel", len(dados)):
+        if not rapido:
+            with pd.ExcelWriter(buffer_xlsx, engine="xlsxwriter") as writer:
+                for sheet, tabela in abas.items():
+                    tabela.to_excel(writer, sheet_name=sheet, index=False)
+        else:
+            import xlsxwriter
+            wb = xlsxwriter.Workbook(buffer_xlsx, {"constant_memory": True})
+            # mesmos formatos do pandas: cabeçalho em negrito com borda, data com hora
+            fmts = {"header": wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"}),
+                    "datetime": wb.add_format({"num_format": "yyyy-mm-dd hh:mm:ss"})}
+            for sheet, tabela in abas.items():
+                _write_sheet_rows(wb, sheet, tabela, fmts)
+            wb.close()
+    return buffer_xlsx.getvalue()
+
+# ===== Imports pesados sob demanda =====
+# matplotlib (e seu cache de fontes) só entra quando um PDF é pedido, e o xlsxwriter só no
+# Excel rápido: a primeira tela do app não paga por eles. `warm_up` (chamado pelo start.sh)
+# carrega tudo antes do servidor aceitar conexões.
+def load_matplotlib():
+    """Importa o matplotlib com o backend Agg (sem janela), fixado uma vez por processo."""
+    if "matplotlib.figure" in sys.modules:
+        return
+    with stage("import_matplotlib"):
+        import matplotlib
+        matplotlib.use("Agg")
+        importlib.import_module("matplotlib.figure")
+        importlib.import_module("matplotlib.backends.backend_pdf")
+
+WARM_UP = None  # registro do aquecimento deste processo (painel de debug)
+
+def warm_up(log=None) -> dict:
+    """Pré-importa os módulos pesados e monta o cache de fontes com uma página de PDF de teste.
+
+    Cada passo vira uma etapa de um Trace (origem=aquecimento), gravado em `log` ("-" = stderr)."""
+    tr = Trace(origem="aquecimento", pid=os.getpid()).start()
+    load_matplotlib()
+    with stage("fontes_matplotlib"):
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(2, 1))
+        fig.text(0.1, 0.5, "Relatório CRM — Ç ã 0123")
+        fig.savefig(BytesIO(), format="pdf")
+    for mod in ("xlsxwriter", "altair"):
+        with stage(f"import_{mod}"):
+            importlib.import_module(mod)
+    global WARM_UP
+    WARM_UP = tr.record()
+    if log:
+        tr.log(log)
+    return WARM_UP
+
+# ===== PDF: uma função por página (API OO do matplotlib, sem o estado global do pyplot) =====
+# Cada página é (função, tamanho, args) com args pequenos e serializáveis, então pode ser
+# desenhada em outro processo. Com muitas páginas (ex.: uma por vendedora) as páginas são
+# rasterizadas em paralelo (PNG a PDF_DPI) e juntadas na ordem; abaixo de
+# PDF_PARALLEL_MIN_PAGES o custo de alimentar os processos não compensa e o PDF sai vetorial.
+PDF_WORKERS = int(os.environ.get("CRM_PDF_WORKERS", 0)) or os.cpu_count() or 1
+PDF_PARALLEL_MIN_PAGES = 8
+PDF_DPI = 150
+
+def _pdf_capa(fig, resumo):
+    ax = fig.add_subplot(); ax.axis("off")
+    ax.text(0.05, 0.75, "Relatório CRM", fontsize=24, weight="bold")
+    ax.text(0.05, 0.6, resumo, fontsize=14)
+
+def _pdf_leads_canal(fig, base_plot):
+    ax = fig.add_subplot()
+    ax.barh(base_plot["Canal de Origem"], base_plot["Leads Recebidos"])
+    ax.set_xlabel("Leads"); ax.set_title("Leads por Canal"); fig.tight_layout()
+
+def _pdf_conversoes(fig, conv_plot):
+    ax = fig.add_subplot()
+    conv_plot.plot(kind="barh", ax=ax)
+    ax.set_xlabel("%"); ax.set_title("Conversões por Canal"); fig.tight_layout()
+
+def _pdf_vendedoras(fig, pv):
+    ax = fig.add_subplot()
+    pv.plot(kind="barh", ax=ax)
+    ax.set_title("Leads/Reuniões/Vendas por Vendedora (base filtrada)"); fig.tight_layout()
+
+def _pdf_funil_vendedoras(fig, pf_plot):
+    ax = fig.add_subplot()
+    pf_plot.plot(kind="bar", stacked=False, ax=ax)
+    ax.tick_params(axis="x", labelrotation=45)
+    for t in ax.get_xticklabels(): t.set_ha("right")
+    ax.set_title("Funil por Vendedora (base filtrada)"); fig.tight_layout()
+
+def _pdf_vendedora(fig, nome, resumo, fases):
+    ax_txt, ax = fig.subplots(1, 2, width_ratios=[1, 2])
+    ax_txt.axis("off")
+    ax_txt.text(0, 0.9, str(nome), fontsize=18, weight="bold", va="top")
+    ax_txt.text(0, 0.7, resumo, fontsize=12, va="top")
+    ax.barh(fases.index, fases.to_numpy(), color=[phase_colors[phase_rank[f]] for f in fases.index])
+    ax.invert_yaxis(); ax.set_xlabel("Leads"); ax.set_title("Funil da vendedora (base filtrada)")
+    fig.tight_layout()
+
+def pdf_pages(rel, periodo, por_vendedora=False) -> list:
+    """Páginas do PDF, na ordem: capa, canais, conversões, vendedoras e (opcional) uma por vendedora."""
+    fases_tot, funil, conv = rel["fases_tot"], rel["funil_df"], rel["conv_df"]
+    vend_resumo, vend_funil = rel["prospec_resumo_df"], rel["prospec_funil_df"]
+    d_ini, d_fim = periodo
+    periodo_txt = f"{d_ini.strftime('%d/%m/%Y')} a {d_fim.strftime('%d/%m/%Y')}"
+    resumo = (
+        f"Período: {periodo_txt}\n"
+        f"Leads: {len(rel['df'])} | Reuniões: {int(reunioes(fases_tot))} | "
+        f"Em Proposta: {int(fases_tot['Proposta e Negociação'])} | "
+        f"Finalizando Venda: {int(fases_tot['Finalizando Venda'])} | "
+        f"Vendas: {int(fases_tot['Negócio Fechado'])}"
+    )
+    pages = [(_pdf_capa, (10, 6), (resumo,))]
+    base_plot = funil[funil["Canal de Origem"]!="TOTAL"][["Canal de Origem","Leads Recebidos"]]
+    pages.append((_pdf_leads_canal, (10, 6), (base_plot,)))
+    conv_plot = conv[conv["Canal de Origem"]!="TOTAL"].set_index("Canal de Origem")
+    pages.append((_pdf_conversoes, (10, 6), (conv_plot[["% Reuniões/Leads","% Vendas/Leads","% Vendas/Reuniões"]],)))
+    pv = vend_resumo[vend_resumo["Vendedora"]!="TOTAL"].set_index("Vendedora")
+    if not pv.empty:
+        pages.append((_pdf_vendedoras, (10, 6), (pv[["Leads Gerados","Reuniões Agendadas","Vendas"]],)))
+    if not vend_funil.empty:
+        # garantir colunas na ordem (inclui Finalizando)
+        cols_plot = [c for c in phase_order if c in vend_funil.columns]
+        pf_plot = vend_funil[vend_funil["Vendedora"]!="TOTAL"].set_index("Vendedora")[cols_plot]
+        pages.append((_pdf_funil_vendedoras, (11, 6), (pf_plot,)))
+        if por_vendedora:
+            for nome, fases in pf_plot.iterrows():
+                r = pv.loc[nome]
+                txt = (f"Leads: {int(r['Leads Gerados'])}\nReuniões: {int(r['Reuniões Agendadas'])}\n"
+                       f"Vendas: {int(r['Vendas'])}\nConversão reunião: {r['Conversão Reunião (%)']}%\n"
+                       f"Conversão venda: {r['Conversão Venda (%)']}%")
+                pages.append((_pdf_vendedora, (10, 6), (nome, txt, fases)))
+    return pages
+
+def _new_page(page):
+    load_matplotlib()
+    from matplotlib.figure import Figure
+    func, figsize, args = page
+    fig = Figure(figsize=figsize)
+    func(fig, *args)
+    return fig
+
+def _raster_page(page, dpi=PDF_DPI) -> bytes:
+    buf = BytesIO()
+    _new_page(page).savefig(buf, format="png", dpi=dpi, bbox_inches="tight")
+    return buf.getvalue()
+
+def build_pdf(rel, periodo, por_vendedora=False, workers=None) -> bytes:
+    """PDF do relatório. `workers`: processos para desenhar as páginas (None = automático)."""
+    pages = pdf_pages(rel, periodo, por_vendedora)
+    if workers is None:
+        workers = PDF_WORKERS if len(pages) >= PDF_PARALLEL_MIN_PAGES else 1
+    workers = min(workers, len(pages))
+    load_matplotlib()
+    import matplotlib.image as mpimg
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+    pdf_bytes = BytesIO()
+    with stage("pdf"), PdfPages(pdf_bytes) as pdf:
+        if workers <= 1:
+            for page in pages:
+                pdf.savefig(_new_page(page), bbox_inches="tight")
+        else:
+            # pool por PDF (spawn: seguro dentro do servidor com threads; nada fica vivo depois)
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                for png in pool.map(_raster_page, pages):  # chega na ordem das páginas
+                    img = mpimg.imread(BytesIO(png))
+                    fig = Figure(figsize=(img.shape[1] / PDF_DPI, img.shape[0] / PDF_DPI), dpi=PDF_DPI)
+                    fig.figimage(img)
+                    pdf.savefig(fig)
+    return pdf_bytes.getvalue()
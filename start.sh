@@ -2,10 +2,25 @@
 set -e
 
 # roda o streamlit sem usar config.toml
-exec streamlit run app.py \
-  --server.headless true \
-  --server.address 0.0.0.0 \
-  --server.port "$PORT" \
-  --server.enableCORS false \
-  --server.enableXsrfProtection false \
-  --browser.gatherUsageStats false
+ARGS=(run app.py
+  --server.headless true
+  --server.address 0.0.0.0
+  --server.port "$PORT"
+  --server.enableCORS false
+  --server.enableXsrfProtection false
+  --browser.gatherUsageStats false)
+
+# Aquecimento (CRM_WARMUP=0 desliga): no próprio processo do servidor, antes de abrir a porta,
+# importa matplotlib/xlsxwriter/altair e monta o cache de fontes. Os tempos saem como uma linha
+# JSON em $CRM_METRICS_LOG (ou no stderr).
+if [ "${CRM_WARMUP:-1}" != "0" ]; then
+  exec python -c '
+import os, sys
+import crm_report
+crm_report.warm_up(os.environ.get("CRM_METRICS_LOG") or "-")
+from streamlit.web.cli import main
+sys.argv[0] = "streamlit"
+sys.exit(main())
+' "${ARGS[@]}"
+fi
+exec streamlit "${ARGS[@]}"